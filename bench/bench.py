@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+### Benchmarks ###
+# Runs the serve-whome daemon against bench/fakepk.py in a scratch directory and times the startup path and the functions on
+# the poll path, reporting throughput and peak memory so regressions show up before deployment
+# The pktools submodule needs to be checked out, as servewhome imports it
+
+benchLocation = os.path.dirname(os.path.abspath(__file__))
+repoLocation = os.path.dirname(benchLocation)
+
+# servewhome is imported from this checkout
+sys.path.insert(0, repoLocation)
+from servewhome.app import whomeDaemon
+from servewhome.pkclient import pkClient
+
+# argparse setup
+parser = argparse.ArgumentParser()
+parser.add_argument("--members", type=int, default=200, help="Members in the generated system")
+parser.add_argument("--groups", type=int, default=16, help="Groups in the generated system")
+parser.add_argument("--switches", type=int, default=20000, help="Switches in the generated system")
+parser.add_argument("--new", type=int, default=150, help="Switches to log between polls for the busy pullPeriodic run")
+parser.add_argument("--repeat", type=int, default=20, help="Times to repeat each of the quick functions")
+parser.add_argument("--replay", help="Replay the system in this serve-whome data directory instead of generating one")
+parser.add_argument("--json", help="Also write the results to this file as json")
+
+results = []
+
+# Peak resident memory of this process in MB
+def peakRss():
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+# Time a function, items is how many things one call deals with and is used to work out throughput
+def measure(name, function, repeat=1, items=None, unit="items"):
+  times = []
+  for i in range(repeat):
+    start = time.perf_counter()
+    function()
+    times.append(time.perf_counter() - start)
+  best = min(times)
+  result = {"name": name, "best": best, "mean": sum(times) / len(times), "runs": repeat, "peakRssMB": round(peakRss(), 1)}
+  if items:
+    result["throughput"] = items / best
+    result["unit"] = unit
+  results.append(result)
+
+  line = name.ljust(34) + ("%9.2f ms" % (best * 1000)) + ("  mean %9.2f ms" % (result["mean"] * 1000)) + ("  peak %7.1f MB" % result["peakRssMB"])
+  if items:
+    line = line + ("  %12.0f %s/s" % (result["throughput"], unit))
+  print(line, flush=True)
+
+def freePort():
+  with socket.socket() as s:
+    s.bind(("127.0.0.1", 0))
+    return s.getsockname()[1]
+
+def startFakePk(args, port):
+  command = [sys.executable, benchLocation + "/fakepk.py", "--port", str(port)]
+  if args.replay:
+    command = command + ["--replay", args.replay]
+  else:
+    command = command + ["--members", str(args.members), "--groups", str(args.groups), "--switches", str(args.switches)]
+  process = subprocess.Popen(command)
+
+  # Wait for it to start listening
+  for i in range(200):
+    try:
+      urllib.request.urlopen("http://127.0.0.1:" + str(port) + "/v2/systems/fakes")
+      return process
+    except Exception:
+      time.sleep(0.05)
+  process.kill()
+  raise RuntimeError("Fake PluralKit didn't start")
+
+# Config for a daemon using the fake api and a scratch data directory
+def makeConfig(scratch, port, groups):
+  config = {
+    "updateInterval": 1,
+    "timeout": 0,
+    "data": scratch + "/data",
+    "pluralkit": {"token": "bench", "systemID": "fakes", "zeropoint": "2000-01-01T00:00:00Z", "api": "http://127.0.0.1:" + str(port) + "/v2"},
+    "discord": {"full": {"enabled": False}, "filtered": {"enabled": False}, "outbox": scratch + "/outbox.json"},
+    "mqtt": {"enabled": False},
+    "groups": {"cards": [i["id"] for i in groups[0::2]], "elements": [i["id"] for i in groups[1::2]]},
+    "covers": {}
+  }
+  return config
+
+# Startup followed by catching up with pluralkit, on a cold start this downloads everything, on a warm start it is all on disc
+def startDaemon(config):
+  daemon = whomeDaemon(config, pkClient(config["pluralkit"]["token"], config["pluralkit"]["api"]))
+  daemon.startup()
+  daemon.catchUp()
+  # The server downloads any missing history in the background, here it is done straight away so it is part of the timing,
+  # the same way backfillJob() does it but with a checkpoint only at the end
+  while not daemon.state.switchStore.isComplete() and not daemon.state.backfillPage():
+    pass
+  daemon.state.backfillCheckpoint()
+  daemon.state.flush()
+  return daemon
+
+def postSwitches(port, count, members):
+  for i in range(count):
+    request = urllib.request.Request("http://127.0.0.1:" + str(port) + "/v2/systems/fakes/switches", data=json.dumps({"members": [members[i % len(members)]["id"]]}).encode(), headers={"Content-Type": "application/json"}, method="POST")
+    urllib.request.urlopen(request).read()
+
+def main():
+  args = parser.parse_args()
+  port = freePort()
+  fakePk = startFakePk(args, port)
+  base = "http://127.0.0.1:" + str(port) + "/v2/systems/fakes"
+  groups = json.load(urllib.request.urlopen(base + "/groups"))
+  members = json.load(urllib.request.urlopen(base + "/members"))
+  switchCount = args.switches
+
+  try:
+    with tempfile.TemporaryDirectory() as scratch:
+      config = makeConfig(scratch, port, groups)
+
+      daemon = None
+      def coldStart():
+        nonlocal daemon
+        daemon = startDaemon(config)
+      measure("startup (cold)", coldStart, items=switchCount, unit="switches")
+      state = daemon.state
+      switchCount = state.switchStore.count()
+      measure("startup (warm)", lambda: startDaemon(config))
+
+      measure("syncNewSwitches (synced)", state.syncNewSwitches, args.repeat)
+      measure("rebuildMemberSeen", state.rebuildMemberSeen, args.repeat, switchCount, "switches")
+      measure("buildStats", state.buildStats, args.repeat, switchCount, "switches")
+      measure("buildMemberList", state.buildMemberList, args.repeat, len(members), "members")
+      measure("updateCurrentFronters", state.updateCurrentFronters, args.repeat * 10)
+      measure("pullPeriodic (no new switches)", state.pullPeriodic, args.repeat)
+
+      postSwitches(port, args.new, members)
+      measure("pullPeriodic (" + str(args.new) + " new switches)", state.pullPeriodic, 1, args.new, "switches")
+      measure("flush", state.flush, 1)
+  finally:
+    fakePk.kill()
+
+  if args.json:
+    with open(args.json, "w") as outputFile:
+      outputFile.write(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+import argparse
+import datetime
+import json
+import sys
+import urllib.error
+import urllib.request
+import uuid
+
+### Dispatch webhook poster ###
+# Posts PluralKit dispatch events to serve-whome's webhook endpoint, so webhook handling can be tried locally without
+# PluralKit: either recorded payloads from files, or a CREATE_SWITCH made up on the spot
+# e.g. python3 bench/dispatch.py --token abc --switch abcde fghij
+#      python3 bench/dispatch.py --token abc recorded/*.json
+
+# argparse setup
+parser = argparse.ArgumentParser()
+parser.add_argument("--url", default="http://127.0.0.1:8080/dispatch", help="Webhook endpoint to post to")
+parser.add_argument("--token", help="Signing token to put in each event, replaces any in a recorded payload")
+parser.add_argument("--system", help="System uuid to put in each event, replaces any in a recorded payload")
+parser.add_argument("--switch", nargs="*", metavar="MEMBER", help="Post a new switch to these member ids instead of reading files, none switches out")
+parser.add_argument("payloads", nargs="*", help="Files holding one recorded event each")
+
+def post(url, event):
+  request = urllib.request.Request(url, data=json.dumps(event).encode(), headers={"Content-Type": "application/json"}, method="POST")
+  try:
+    with urllib.request.urlopen(request) as response:
+      return response.status
+  except urllib.error.HTTPError as e:
+    return e.code
+
+if __name__ == "__main__":
+  args = parser.parse_args()
+
+  events = []
+  if args.switch is not None:
+    timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="microseconds").replace("+00:00", "Z")
+    switchId = str(uuid.uuid4())
+    events.append({"type": "CREATE_SWITCH", "id": switchId, "data": {"id": switchId, "timestamp": timestamp, "members": args.switch}})
+  for path in args.payloads:
+    with open(path, "r") as payloadFile:
+      events.append(json.load(payloadFile))
+  if len(events) == 0:
+    parser.error("give either --switch or payload files")
+
+  for event in events:
+    if args.token is not None:
+      event["signing_token"] = args.token
+    if args.system is not None:
+      event["system_id"] = args.system
+    status = post(args.url, event)
+    print(str(event.get("type")) + " " + str(status))
+    if status != 200:
+      sys.exit(1)
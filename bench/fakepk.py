@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import urllib.parse
+import uuid
+import struct
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+### Fake PluralKit ###
+# A local stand-in for the parts of the PluralKit v2 API that serve-whome.py uses, either with a generated system of
+# any size or replaying a real system from an existing data directory, so nothing has to touch api.pluralkit.me
+
+# argparse setup
+parser = argparse.ArgumentParser()
+parser.add_argument("--port", type=int, default=8801, help="Port to listen on")
+parser.add_argument("--members", type=int, default=100, help="Number of members to generate")
+parser.add_argument("--groups", type=int, default=8, help="Number of groups to generate")
+parser.add_argument("--switches", type=int, default=10000, help="Number of switches to generate")
+parser.add_argument("--seed", type=int, default=1, help="Random seed, the same seed always generates the same system")
+parser.add_argument("--replay", help="Serve the system in this serve-whome data directory instead of generating one")
+parser.add_argument("--avatars", action="store_true", help="Give every member an avatar, served by this server as a generated png with an ETag")
+parser.add_argument("--rate-limit", type=int, default=1000, help="Requests per second to advertise in the X-RateLimit headers")
+
+### Synthetic systems ###
+
+def makeId(number):
+  letters = "abcdefghijklmnopqrstuvwxyz"
+  text = ""
+  for i in range(5):
+    text = letters[number % 26] + text
+    number = number // 26
+  return text
+
+def makeMember(number):
+  return {
+    "id": makeId(number),
+    "uuid": str(uuid.UUID(int=number + 1)),
+    "name": "Member " + str(number),
+    "display_name": None if number % 3 else "Display " + str(number),
+    "pronouns": ["she/her", "he/him", "they/them", None][number % 4],
+    "avatar_url": None,
+    "proxy_tags": [{"prefix": None, "suffix": "-" + makeId(number)}],
+    "privacy": {"visibility": "private" if number % 10 == 0 else "public"}
+  }
+
+def makeGroup(number, members):
+  return {
+    "id": "g" + makeId(number)[1:],
+    "uuid": str(uuid.UUID(int=10 ** 9 + number)),
+    "name": "Group " + str(number),
+    "members": [i["uuid"] for i in members[number::number + 2]]
+  }
+
+def generate(args):
+  random.seed(args.seed)
+  members = [makeMember(i) for i in range(args.members)]
+  groups = [makeGroup(i, members) for i in range(args.groups)]
+
+  # Switches spread over the time leading up to now, mostly single fronters with some co-fronting and switching out
+  # They are made working backwards from now, so the newest is always in the past and anything posted later is newer than it
+  switches = []
+  timestamp = datetime.datetime.now(datetime.timezone.utc)
+  for i in range(args.switches):
+    timestamp = timestamp - datetime.timedelta(minutes=random.randint(1, 359))
+    fronters = random.sample(members, min(len(members), random.choice([0, 1, 1, 1, 1, 2, 2, 3])))
+    switches.append({"id": str(uuid.UUID(int=2 * 10 ** 9 + args.switches - 1 - i)), "timestamp": timestamp.isoformat(timespec="microseconds").replace("+00:00", "Z"), "members": [m["id"] for m in fronters]})
+  switches.reverse()
+  created = (timestamp - datetime.timedelta(minutes=1)).isoformat(timespec="microseconds").replace("+00:00", "Z")
+
+  system = {"id": "fakes", "uuid": str(uuid.UUID(int=0)), "name": "Fake System", "pronouns": "they/them", "created": created}
+  return system, members, groups, switches
+
+def replay(location):
+  location = os.path.expanduser(location)
+  with open(location + "/pkSystem.json", "r") as systemFile:
+    system = json.load(systemFile)
+  with open(location + "/pkMembers.json", "r") as membersFile:
+    members = json.load(membersFile)
+  with open(location + "/pkGroups.json", "r") as groupsFile:
+    groups = json.load(groupsFile)
+  db = sqlite3.connect(location + "/pkSwitches.db")
+  switches = [{"id": row[0], "timestamp": row[1], "members": json.loads(row[2])} for row in db.execute("SELECT id, timestamp, members FROM switches ORDER BY epoch ASC, id ASC")]
+  return system, members, groups, switches
+
+# A 256x256 png of one colour, so avatars can be served without needing any image libraries
+def makeAvatar(number):
+  colour = bytes([(number * 67) % 256, (number * 139) % 256, (number * 29) % 256])
+  rows = b"".join(b"\x00" + colour * 256 for i in range(256))
+  def chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+  return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", 256, 256, 8, 2, 0, 0, 0)) + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b"")
+
+### Server ###
+
+def toEpoch(timestamp):
+  return datetime.datetime.fromisoformat(timestamp.replace("Z", "+00:00")).timestamp()
+
+class fakeSystem:
+  def __init__(self, system, members, groups, switches):
+    self.system = system
+    self.members = members
+    self.groups = groups
+    # Newest first, the same way PluralKit returns them
+    self.switches = switches[::-1]
+    self.epochs = [toEpoch(i["timestamp"]) for i in self.switches]
+    self.lock = threading.Lock()
+    self.requests = 0
+
+  def getSwitches(self, before, limit):
+    with self.lock:
+      start = 0
+      if before is not None:
+        cutoff = toEpoch(before)
+        while start < len(self.epochs) and self.epochs[start] >= cutoff:
+          start = start + 1
+      return self.switches[start:start + min(limit, 100)]
+
+  def getSwitch(self, switchId):
+    with self.lock:
+      return next((i for i in self.switches if i["id"] == switchId), None)
+
+  def addSwitch(self, members):
+    with self.lock:
+      now = datetime.datetime.now(datetime.timezone.utc)
+      switch = {"id": str(uuid.uuid4()), "timestamp": now.isoformat(timespec="microseconds").replace("+00:00", "Z"), "members": members}
+      # Newest first, a replayed history can run past now so the switch goes wherever its timestamp puts it
+      index = 0
+      while index < len(self.epochs) and self.epochs[index] > now.timestamp():
+        index = index + 1
+      self.switches.insert(index, switch)
+      self.epochs.insert(index, now.timestamp())
+      return switch
+
+def makeHandler(fake, rateLimit):
+  class handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out as separate writes, without this delayed ACKs add 40ms to every request
+    disable_nagle_algorithm = True
+
+    def send(self, status, data):
+      body = json.dumps(data).encode()
+      self.send_response(status)
+      self.send_header("Content-Type", "application/json")
+      self.send_header("Content-Length", str(len(body)))
+      self.send_header("X-RateLimit-Limit", str(rateLimit))
+      self.send_header("X-RateLimit-Remaining", str(rateLimit - 1))
+      self.send_header("X-RateLimit-Reset", str(int((time.time() + 1) * 1000)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def sendAvatar(self, name):
+      number = next((i for i, member in enumerate(fake.members) if member["id"] + ".png" == name), None)
+      if number is None:
+        self.send(404, {"message": "Not found", "code": 0})
+        return
+      body = makeAvatar(number)
+      etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+      if self.headers.get("If-None-Match") == etag:
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        return
+      self.send_response(200)
+      self.send_header("Content-Type", "image/png")
+      self.send_header("Content-Length", str(len(body)))
+      self.send_header("ETag", etag)
+      self.end_headers()
+      self.wfile.write(body)
+
+    def do_GET(self):
+      fake.requests = fake.requests + 1
+      url = urllib.parse.urlsplit(self.path)
+      query = urllib.parse.parse_qs(url.query)
+      parts = url.path.strip("/").split("/")
+      if parts[0] == "avatars" and len(parts) == 2:
+        self.sendAvatar(parts[1])
+      elif parts[:2] != ["v2", "systems"] or len(parts) < 3:
+        self.send(404, {"message": "Not found", "code": 0})
+      elif len(parts) == 3:
+        self.send(200, fake.system)
+      elif parts[3] == "members":
+        self.send(200, fake.members)
+      elif parts[3] == "groups":
+        self.send(200, fake.groups)
+      elif parts[3] == "switches" and len(parts) == 5:
+        switch = fake.getSwitch(parts[4])
+        self.send(200, switch) if switch is not None else self.send(404, {"message": "Switch not found.", "code": 20006})
+      elif parts[3] == "switches":
+        self.send(200, fake.getSwitches(query.get("before", [None])[0], int(query.get("limit", ["100"])[0])))
+      else:
+        self.send(404, {"message": "Not found", "code": 0})
+
+    def do_POST(self):
+      fake.requests = fake.requests + 1
+      body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+      if self.path.rstrip("/").endswith("/switches"):
+        self.send(200, fake.addSwitch(body.get("members", [])))
+      else:
+        self.send(404, {"message": "Not found", "code": 0})
+
+    def log_message(self, format, *args):
+      pass
+
+  return handler
+
+if __name__ == "__main__":
+  args = parser.parse_args()
+  fake = fakeSystem(*(replay(args.replay) if args.replay else generate(args)))
+  if args.avatars:
+    for member in fake.members:
+      member["avatar_url"] = "http://127.0.0.1:" + str(args.port) + "/avatars/" + member["id"] + ".png"
+  print("Fake PluralKit on port " + str(args.port) + ": " + str(len(fake.members)) + " members, " + str(len(fake.groups)) + " groups, " + str(len(fake.switches)) + " switches", flush=True)
+  ThreadingHTTPServer(("127.0.0.1", args.port), makeHandler(fake, args.rate_limit)).serve_forever()
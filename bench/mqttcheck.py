@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+
+### MQTT publisher check ###
+# Runs servewhome's mqttPublisher against an in-process stub broker, feeding it one currentFronters and then another, and
+# checks that discovery is sent and that only the topics whose values changed are published again
+# Doesn't need paho-mqtt or a broker, to try it against a real one point mqtt: in the config at a local Mosquitto instead
+
+benchLocation = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(benchLocation))
+from servewhome.mqttpublish import mqttPublisher
+
+# Stands in for paho's client, remembers everything published rather than sending it
+class stubClient:
+  def __init__(self):
+    self.on_connect = None
+    self.messages = []
+
+  def is_connected(self):
+    return True
+
+  def publish(self, topic, payload, retain=False):
+    self.messages.append((topic, payload, retain))
+
+def makeFronters(members):
+  return {"switch": {"id": "s", "timestamp": "2026-01-01T00:00:00Z"}, "system": {"name": "Test System", "pronouns": "they/them"}, "members": members}
+
+def makeMember(name, pronouns, lastIn, lastOut):
+  return {"name": name, "displayName": name, "id": name.lower()[:5], "pronouns": pronouns, "visible": True, "lastIn": lastIn, "lastOut": lastOut}
+
+def main():
+  client = stubClient()
+  publisher = mqttPublisher({}, "abcde", client)
+
+  publisher.update(makeFronters([makeMember("Alice", "she/her", "2026-01-01T00:00:00Z", "2025-12-31T00:00:00Z")]))
+  discovery = [topic for topic, payload, retain in client.messages if topic.endswith("/config")]
+  assert len(discovery) == 4, discovery
+  state = {topic: payload for topic, payload, retain in client.messages if not topic.endswith("/config")}
+  assert state == {"whome-abcde/front": "Alice", "whome-abcde/pronouns": "she/her", "whome-abcde/lastin": "2026-01-01T00:00:00Z", "whome-abcde/lastseen": "2025-12-31T00:00:00Z"}, state
+  assert all(retain for topic, payload, retain in client.messages)
+
+  # Same pronouns, so only the other three are sent again
+  client.messages = []
+  publisher.update(makeFronters([makeMember("Bobby", "she/her", "2026-01-02T00:00:00Z", "2025-12-30T00:00:00Z")]))
+  topics = sorted(topic for topic, payload, retain in client.messages)
+  assert topics == ["whome-abcde/front", "whome-abcde/lastin", "whome-abcde/lastseen"], topics
+
+  # Nothing has changed, nothing is sent
+  client.messages = []
+  publisher.update(makeFronters([makeMember("Bobby", "she/her", "2026-01-02T00:00:00Z", "2025-12-30T00:00:00Z")]))
+  assert client.messages == [], client.messages
+
+  print("mqttPublisher only published what changed")
+
+if __name__ == "__main__":
+  main()
@@ -1,8 +1,7 @@
 
 function draw(members)
 {
-    // Sort members alphabetically by name
-    members.sort((a,b) => a["name"].toLowerCase() > b["name"].toLowerCase())
+    // Members come already sorted alphabetically by name, see buildSystemView() in servewhome/state.py
 
     // Get the HTML element to put the members into
     var listEl = document.getElementById("members")
@@ -38,6 +37,6 @@ function draw(members)
     });
 }
 
-fetch("./memberList.json", {"cache": "no-store"})
+fetch("./viewSystem.json", {"cache": "no-cache"})
   .then((response) => response.json())
-  .then((json) => draw(json));
\ No newline at end of file
+  .then((json) => draw(json["members"]));
\ No newline at end of file
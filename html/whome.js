@@ -1,55 +1,28 @@
 async function run() {
   var element = document.getElementById("data")
-  var zeropoint = "2000-01-01T00:00:00Z"
 
-  var memberSeen = {}
+  // One precomputed file has everything this page needs, see buildWhomeView() in servewhome/state.py
+  var view = {}
   try {
-    const response = await fetch("./memberSeen.json");
+    const response = await fetch("./viewWhome.json", {"cache": "no-cache"});
     if (!response.ok) {
       throw new Error(`Response status: ${response.status}`);
     }
 
-    memberSeen = await response.json();
+    view = await response.json();
   } catch (error) {
     console.error(error.message);
   }
 
-  var lastSwitch = {}
-  try {
-    const response = await fetch("./lastSwitch.json");
-    if (!response.ok) {
-      throw new Error(`Response status: ${response.status}`);
-    }
-
-    lastSwitch = await response.json();
-  } catch (error) {
-    console.error(error.message);
+  if (view["fronters"] && view["fronters"].length > 0)
+  {
+    var fronter = view["fronters"][0]
+    var rsFrontedSeconds = rsSinceLastIn(fronter["id"], view["memberSeen"])
+    var humanRsFronted = new Date(rsFrontedSeconds * 1000).toISOString().slice(11, 16);
+    element.innerHTML = fronter["name"] + ": " 
+      + humanRsFronted + " = " + hsTimeHuman(hsSinceLastIn(fronter["id"], view["memberSeen"]))
   }
 
-  var memberList = {}
-  try {
-    const response = await fetch("./memberList.json");
-    if (!response.ok) {
-      throw new Error(`Response status: ${response.status}`);
-    }
-
-    memberList = await response.json();
-  } catch (error) {
-    console.error(error.message);
-  }
-
-  var currentFronters = lastSwitch["members"]
-
-  memberList.forEach((member) => {
-    if (member["memberId"] == currentFronters[0])
-    {
-      var rsFrontedSeconds = rsSinceLastIn(currentFronters[0], memberSeen)
-      var humanRsFronted = new Date(rsFrontedSeconds * 1000).toISOString().slice(11, 16);
-      element.innerHTML = member["memberName"] + ": " 
-        + humanRsFronted + " = " + hsTimeHuman(hsSinceLastIn(currentFronters[0], memberSeen))
-    }
-  });
-
   setTimeout(run, 60 * 1000)
 
-}
\ No newline at end of file
+}
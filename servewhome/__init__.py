@@ -0,0 +1,3 @@
+# serve-whome: keeps a local copy of a PluralKit system and serves it to the WhoMe projects
+# Run with serve-whome.py or python3 -m servewhome, see app.main()
+# Nothing is imported here, so switchout.py can use config and control without loading the whole daemon
@@ -0,0 +1,675 @@
+import argparse
+import asyncio
+import datetime
+import hmac
+import json
+import logging
+import os
+import shutil
+import time
+import requests
+from .state import pktState
+from .pkclient import pkClient
+from .config import loadConfig, systemConfigs, checkSystemConfigs
+from .switchstore import switchStore
+from .history import frontHistory, toIso
+from .httpserver import whomeServer, documentNames
+from .control import controlServer, controlPath, sendCommand, commands
+from .notify import notifier, discordWebhook
+from .logsetup import setupLogging, logOperation
+from .messages import messageShort, messageLong
+from . import mqttpublish
+from . import metrics
+
+# Where html/ and the pktools submodule live
+repoLocation = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Seconds until the start of the next minute that is a multiple of the update interval
+def secondsUntilInterval(minutes):
+  now = datetime.datetime.now()
+  deadline = now.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+  while deadline.minute % minutes != 0:
+    deadline = deadline + datetime.timedelta(minutes=1)
+  return (deadline - now).total_seconds()
+
+# Seconds until the next time the local clock reads hour:minute
+def secondsUntilTime(hour, minute):
+  now = datetime.datetime.now()
+  deadline = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+  if deadline <= now:
+    deadline = deadline + datetime.timedelta(days=1)
+  return (deadline - now).total_seconds()
+
+# Copy a file into the data directory, only if it is missing or its contents differ from the copy already there
+# Returns: True if the file was copied
+def syncFile(source, destination):
+  if os.path.exists(destination) and os.path.getsize(source) == os.path.getsize(destination):
+    with open(source, "rb") as sourceFile, open(destination, "rb") as destinationFile:
+      if sourceFile.read() == destinationFile.read():
+        return False
+  shutil.copyfile(source, destination + ".tmp")
+  os.replace(destination + ".tmp", destination)
+  return True
+
+class whomeDaemon:
+  # pk is the client for this system's token, offset is how many seconds this system's jobs run after the shared schedule
+  def __init__(self, config, pk, rebuild=False, offset=0):
+    self.config = config
+    self.rebuild = rebuild
+    self.offset = offset
+    self.systemid = config["pluralkit"]["systemID"]
+    self.dataLocation = os.path.expanduser(config["data"])
+
+    # If there is no directory to store the data create it
+    if not os.path.exists(self.dataLocation):
+      logging.info("No data store, creating directory")
+      os.mkdir(self.dataLocation)
+
+    # Every call to PluralKit goes through this client, it shares its connections and rate limit with every other system
+    self.pk = pk
+
+    # Create an object to represent the state of the system
+    self.state = pktState(config, self.pk)
+
+    # Discord webhooks that messages can be sent to, by mode
+    sinks = {}
+    for mode in ["full", "filtered"]:
+      if mode in config["discord"] and config["discord"][mode].get("token"):
+        sinks[mode] = discordWebhook(config["discord"][mode]["serverID"], config["discord"][mode]["token"])
+    self.notifications = notifier(sinks, config["discord"].get("outbox", "./outbox-serve-whome.json"), config["discord"].get("coalesce", 5), system=self.systemid)
+
+    # MQTT publishing for Home Assistant, only runs if enabled in the config
+    self.mqttPublisher = None
+    if "mqtt" in config and config["mqtt"]["enabled"]:
+      if mqttpublish.mqtt is None:
+        logging.critical("MQTT is enabled but paho-mqtt is not installed")
+      else:
+        self.mqttPublisher = mqttpublish.mqttPublisher(config["mqtt"], self.systemid)
+
+    # Built in web server, only runs if enabled in the config
+    self.httpServer = None
+    if "http" in config and config["http"]["enabled"]:
+      self.httpServer = whomeServer(config["http"]["host"], config["http"]["port"], self.dataLocation)
+      if self.state.journal is not None:
+        self.httpServer.setJournal(self.state.journal)
+
+    # PluralKit dispatch webhooks, received by the built in web server, polling drops to reconcileInterval while they are on
+    self.webhook = None
+    webhook = (config.get("http") or {}).get("webhook") or {}
+    if webhook.get("enabled"):
+      if self.httpServer is None:
+        logging.critical("Dispatch webhooks are enabled but the web server isn't, they will not be received")
+      elif not webhook.get("signingToken"):
+        logging.critical("Dispatch webhooks are enabled without a signingToken, they will not be received")
+      else:
+        self.webhook = webhook
+        self.httpServer.setWebhook(webhook.get("path", "/dispatch"), self.receiveDispatch)
+        # Events are handled after the reply has been sent, held here so they aren't garbage collected part way through
+        self.dispatchTasks = set()
+
+    # Jobs that change the state object take this lock so they never run over the top of each other
+    self.stateLock = asyncio.Lock()
+    # Set whenever a new switch has been seen, wakes up the front timeout watchdog
+    self.switchEvent = asyncio.Event()
+    # Set once catchUp() has succeeded, the history backfill waits for it
+    self.readyEvent = asyncio.Event()
+    # Set whenever the members may have new avatars, wakes up the avatar download job
+    self.avatarEvent = asyncio.Event()
+
+### Startup ###
+# Startup only reads what is already on disc, so the web server, nginx and the scheduler have data straight away even if
+# it is a little stale, anything missing or out of date is fetched by catchUp() in the background
+# memberList and stats aren't loaded at all, the copies on disc keep being served until catchUp() rebuilds them
+
+  # Copy the web pages and pktools.js into the data directory, if they have changed
+  def syncStatic(self):
+    sources = [repoLocation + "/html/" + i for i in sorted(os.listdir(repoLocation + "/html"))]
+    sources.append(repoLocation + "/pktools/pktools.js")
+    for source in sources:
+      try:
+        if syncFile(source, self.dataLocation + "/" + os.path.basename(source)):
+          logging.info("Copied " + os.path.basename(source) + " to the data directory")
+      except Exception as e:
+        logging.warning("Unable to copy " + source)
+        logging.warning(e)
+
+  def startup(self):
+    self.syncStatic()
+
+    if not self.rebuild:
+      if self.state.hasData("pkSystem"):
+        self.state.loadPkSystem()
+      if self.state.hasData("pkMembers"):
+        self.state.loadPkMembers()
+      if self.state.hasData("pkGroups"):
+        self.state.loadPkGroups()
+      if self.state.hasData("lastSwitch"):
+        self.state.loadLastSwitch()
+      if self.state.hasData("memberSeen"):
+        self.state.loadMemberSeen()
+
+    # currentFronters isn't kept between runs, so work it out from the last known switch
+    if self.state.isReady():
+      self.state.updateCurrentFronters()
+      self.state.saveCurrentFronters()
+      self.state.flush()
+
+  # Fetch anything startup couldn't load and refresh everything else from pluralkit
+  # Returns: True once the state has everything it needs
+  def catchUp(self):
+    logging.info("( catchUp )")
+    state = self.state
+
+    if state.pkSystem is None:
+      state.makeApiCallPkSystem()
+    if state.pkMembers is None:
+      state.makeApiCallPkMembers()
+    if state.pkGroups is None:
+      state.makeApiCallPkGroups()
+    if state.lastSwitch is None:
+      state.makeApiCallLastSwitch()
+      state.saveLastSwitch()
+    if not state.isReady():
+      return False
+
+    # Apply any switches made while the server was stopped, so the front served and announced is current from the start
+    self.pull()
+
+    # Bring the local switch history up to now, anything older that is missing is downloaded by backfillJob() in the background
+    try:
+      state.syncNewSwitches()
+    except Exception as e:
+      logging.warning("Unable to sync new switches ( catchUp )")
+      logging.warning(e)
+
+    # Index whatever history there is so far for front history queries, it grows as switches arrive and the backfill goes on
+    state.rebuildHistory()
+
+    # Build memberSeen from whatever history there is so far, backfillJob() keeps rebuilding it as more history arrives
+    # A memberSeen already on disc is kept, that includes upgrading from before the switch history was stored locally
+    if self.rebuild or not state.hasData("memberSeen"):
+      state.rebuildMemberSeen()
+      state.setMemberSeenPartial(not state.switchStore.isComplete())
+      state.saveMemberSeen()
+      self.rebuild = False
+
+    # The refresh saves system, members and groups and rebuilds memberList and stats
+    state.refresh()
+    state.updateCurrentFronters()
+    state.saveCurrentFronters()
+    state.flush()
+    return True
+
+### Scheduled jobs ###
+# Each job runs as its own asyncio task and sleeps until its next deadline, blocking work (api calls, file writes) is run in a
+# worker thread so a slow response from PluralKit or Discord only ever delays the job that made it
+
+  # Push the latest data to the built in web server and MQTT, if they are running, waiting web clients are told about any new switch
+  def publishState(self):
+    if self.state.currentFronters is None:
+      return
+    if self.mqttPublisher is not None:
+      self.mqttPublisher.update(self.state.currentFronters)
+    if self.httpServer is None:
+      return
+    for name in documentNames:
+      if name in self.state.texts:
+        self.httpServer.publish(name, self.state.texts[name], self.state.hashes[name])
+    self.httpServer.publishSwitch(self.state.lastSwitch.get("id"))
+
+  # Write this system's metrics to metrics.json in the data directory, if turned on in the config
+  def writeMetrics(self):
+    if not self.config.get("metrics", {}).get("json"):
+      return
+    path = self.dataLocation + "/metrics.json"
+    try:
+      with open(self.dataLocation + "/.metrics.json.tmp", "w") as outputFile:
+        outputFile.write(metrics.metrics.toJson(self.systemid))
+      os.replace(self.dataLocation + "/.metrics.json.tmp", path)
+    except Exception as e:
+      logging.warning("Unable to write " + path)
+      logging.warning(e)
+
+  # Switch all current fronters out
+  # Returns: the switch pluralkit made, or None if it failed
+  def switchOut(self):
+    try:
+      return self.pk.postSwitch(self.systemid, [])
+    except requests.exceptions.RequestException as e:
+      # Fail silently
+      logging.warning("Unable to swtich out")
+      logging.warning(e)
+      return None
+
+  # Switch all current fronters out and apply the switch straight away, rather than leaving it for the next poll
+  # Returns: True if pluralkit accepted the switch
+  async def switchOutNow(self):
+    started = time.perf_counter()
+    switch = await asyncio.to_thread(self.switchOut)
+    if switch is None:
+      return False
+    if self.state.isReady():
+      await self.applyUpdate(self.state.dispatchSwitch, {"id": switch.get("id"), "timestamp": switch.get("timestamp"), "members": []})
+    logOperation("Switched out", "switchout", started, system=self.systemid, switchId=switch.get("id"))
+    return True
+
+  # Refresh system, members and groups from pluralkit, then write out and publish whatever changed
+  async def refreshNow(self):
+    started = time.perf_counter()
+    async with self.stateLock:
+      await asyncio.to_thread(self.state.refresh)
+      await asyncio.to_thread(self.state.flush)
+      await asyncio.to_thread(self.writeMetrics)
+      self.publishState()
+    logOperation("Refreshed from PluralKit", "refresh", started, system=self.systemid)
+    self.avatarEvent.set()
+
+  # What the control socket's status command reports
+  def status(self):
+    state = self.state
+    lastSwitch = state.lastSwitch if state.lastSwitch is not None and "id" in state.lastSwitch else None
+    return {
+      "ready": state.isReady(),
+      "lastSwitch": {key: lastSwitch[key] for key in ("id", "timestamp", "members")} if lastSwitch is not None else None,
+      "switches": state.switchStore.count(),
+      "historyComplete": state.switchStore.isComplete(),
+      "outbox": len(self.notifications.outbox),
+      "switchOutAt": self.config.get("switchOutAt") or []
+    }
+
+  # Run a command from the control socket, see control.py
+  # Returns: the reply for this system, ok is whether the command worked
+  async def control(self, command):
+    if command == "status":
+      return dict({"ok": True}, **self.status())
+    if not self.state.isReady():
+      return {"ok": False, "error": "still starting up"}
+
+    if command == "switchout":
+      if not await self.switchOutNow():
+        return {"ok": False, "error": "PluralKit didn't accept the switch"}
+    elif command == "refresh":
+      await self.refreshNow()
+    elif command == "rebuild":
+      # Everything worked out from the local switch history, no calls to PluralKit are needed
+      await self.applyUpdate(self.state.rebuildFromHistory)
+    return {"ok": True, "lastSwitch": self.status()["lastSwitch"]}
+
+  # Run catchUp() until it succeeds, backing off while pluralkit is unreachable
+  async def catchUpJob(self):
+    await asyncio.sleep(self.offset)
+    wait = 30
+    while True:
+      started = time.perf_counter()
+      try:
+        async with self.stateLock:
+          ready = await asyncio.to_thread(self.catchUp)
+          self.publishState()
+      except Exception as e:
+        logging.warning("Unable to catch up ( catchUpJob )")
+        logging.warning(e)
+        ready = False
+      if ready:
+        logOperation("Caught up with PluralKit", "catchUp", started, system=self.systemid, switchId=self.state.lastSwitch.get("id"))
+        self.switchEvent.set()
+        self.readyEvent.set()
+        return
+      logging.warning("Unable to fetch system data from pluralkit, trying again in " + str(wait) + " seconds")
+      await asyncio.sleep(wait)
+      wait = min(wait * 2, 3600)
+
+  # Download any switch history that is missing, a page at a time, while everything else carries on as normal
+  # The api calls don't need the state lock, it is only taken every checkpointInterval seconds to rebuild memberSeen, memberList
+  # and stats from the history downloaded so far, and once more when it is finished
+  async def backfillJob(self, checkpointInterval=30):
+    await self.readyEvent.wait()
+    state = self.state
+    if state.switchStore.isComplete():
+      return
+    logging.warning("Downloading switch history in the background, this can take several minutes")
+
+    wait = 30
+    lastCheckpoint = time.monotonic()
+    complete = False
+    while not complete:
+      try:
+        complete = await asyncio.to_thread(state.backfillPage)
+        wait = 30
+      except Exception as e:
+        logging.warning("Unable to download switch history, trying again in " + str(wait) + " seconds")
+        logging.warning(e)
+        await asyncio.sleep(wait)
+        wait = min(wait * 2, 3600)
+        continue
+
+      progress = await asyncio.to_thread(state.backfillProgress)
+      metrics.backfillSwitches.set(progress["switches"], system=self.systemid)
+      if progress["percent"] is not None:
+        metrics.backfillPercent.set(progress["percent"], system=self.systemid)
+      logging.info("Switch history: " + str(progress["switches"]) + " switches back to " + str(progress["oldest"]) + ("" if progress["percent"] is None else ", " + str(progress["percent"]) + "%"))
+
+      if complete or time.monotonic() - lastCheckpoint >= checkpointInterval:
+        started = time.perf_counter()
+        try:
+          async with self.stateLock:
+            await asyncio.to_thread(state.backfillCheckpoint)
+            await asyncio.to_thread(state.flush)
+            self.publishState()
+          logOperation("Rebuilt from the switch history so far", "backfillCheckpoint", started, system=self.systemid)
+        except Exception as e:
+          logging.warning("Unable to rebuild from the switch history ( backfillJob )")
+          logging.warning(e)
+        lastCheckpoint = time.monotonic()
+
+    logging.warning("Switch history downloaded, " + str(progress["switches"]) + " switches")
+
+  # Check pluralkit for new switches every updateInterval minutes, or every reconcileInterval minutes when dispatch webhooks
+  # are bringing switches in as they happen
+  async def pullJob(self):
+    interval = self.config["updateInterval"] if self.webhook is None else self.webhook.get("reconcileInterval", 15)
+    while True:
+      await asyncio.sleep(secondsUntilInterval(interval) + self.offset)
+      if not self.state.isReady():
+        continue
+      try:
+        await self.applyUpdate(self.pull)
+      except Exception as e:
+        # Every job runs in the one gather, so a failure is logged and left for the next poll rather than stopping them all
+        logging.warning("Unable to apply new switches ( pullJob )")
+        logging.warning(e)
+
+  # Poll pluralkit for new switches, timed for the metrics
+  # Returns: True if there has been a switch
+  def pull(self):
+    with metrics.pullSeconds.time(system=self.systemid):
+      switchOccurred = self.state.pullPeriodic()
+    metrics.lastPullTimestamp.set(time.time(), system=self.systemid)
+    return switchOccurred
+
+  # Run an update to the state in a worker thread, then write out and publish whatever it changed and announce any switch
+  # update returns True if there has been a switch
+  async def applyUpdate(self, update, *args):
+    state = self.state
+    started = time.perf_counter()
+    async with self.stateLock:
+      # If update returns true we need to send Discord messages
+      switchOccurred = await asyncio.to_thread(update, *args)
+      if switchOccurred:
+        # Update the current fronters file
+        state.updateCurrentFronters()
+        state.saveCurrentFronters()
+
+      # Write out everything this update changed in one go
+      await asyncio.to_thread(state.flush)
+      await asyncio.to_thread(self.writeMetrics)
+      self.publishState()
+    logOperation("Switch " + str(state.lastSwitch.get("id")) if switchOccurred else "No switch", update.__name__, started, system=self.systemid, switchId=state.lastSwitch.get("id") if switchOccurred else None)
+
+    if switchOccurred:
+      self.switchEvent.set()
+
+      # Check if not switched out
+      if len(state.lastSwitch.get("members", [])) > 0:
+
+        # Build and send full message
+        if self.config["discord"]["full"]["enabled"]:
+          self.notifications.send("full", messageLong(state), "switch")
+
+        # Build and send filtered message
+        if self.config["discord"]["filtered"]["enabled"]:
+          self.notifications.send("filtered", messageShort(state), "switch")
+
+  # Called by the web server with the body of each POST to the webhook path
+  # Returns: the HTTP status to reply with, the event itself is applied after the reply so PluralKit isn't kept waiting
+  async def receiveDispatch(self, body):
+    try:
+      event = json.loads(body)
+    except ValueError:
+      return 400
+    if not isinstance(event, dict):
+      return 400
+    if not hmac.compare_digest(str(event.get("signing_token", "")).encode(), str(self.webhook["signingToken"]).encode()):
+      logging.warning("Dispatch event with the wrong signing token")
+      return 401
+    if self.state.pkSystem is not None and event.get("system_id") is not None and event["system_id"] not in (self.state.pkSystem.uuid, self.state.pkSystem.id):
+      logging.warning("Dispatch event for another system")
+      return 401
+
+    # PluralKit sends a PING when the webhook is set up, anything arriving before the state is ready is left to the next poll
+    if event.get("type") != "PING" and self.state.isReady():
+      task = asyncio.create_task(self.applyDispatch(event))
+      self.dispatchTasks.add(task)
+      task.add_done_callback(self.dispatchDone)
+    return 200
+
+  # Apply a dispatch event to the state, then have the avatar job look at any member that was changed
+  async def applyDispatch(self, event):
+    await self.applyUpdate(self.state.applyDispatch, event)
+    if event.get("type") in ("CREATE_MEMBER", "UPDATE_MEMBER", "DELETE_MEMBER"):
+      self.avatarEvent.set()
+
+  # Called when a dispatch event has been applied, anything that went wrong is logged rather than lost with the task
+  def dispatchDone(self, task):
+    self.dispatchTasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+      logging.warning("Unable to apply dispatch event")
+      logging.warning(task.exception())
+
+  # Refresh from pluralkit every refreshInterval minutes, or at 04:00 each day if that isn't set
+  async def refreshJob(self):
+    while True:
+      if self.config.get("refreshInterval"):
+        await asyncio.sleep(self.config["refreshInterval"] * 60)
+      else:
+        await asyncio.sleep(secondsUntilTime(4, 0) + self.offset)
+      if not self.state.isReady():
+        continue
+      try:
+        await self.refreshNow()
+      except Exception as e:
+        logging.warning("Unable to refresh ( refreshJob )")
+        logging.warning(e)
+
+  # Download members' avatars once caught up, and again after every refresh or member change
+  # The downloads don't take the state lock, it is only taken to point currentFronters and memberList at the new files
+  async def avatarJob(self):
+    if self.state.avatars is None:
+      return
+    await self.readyEvent.wait()
+    while True:
+      self.avatarEvent.clear()
+      try:
+        changed = await asyncio.to_thread(self.state.syncAvatars)
+      except Exception as e:
+        logging.warning("Unable to sync avatars")
+        logging.warning(e)
+        changed = False
+      if changed:
+        try:
+          await self.applyUpdate(self.state.applyAvatars)
+        except Exception as e:
+          logging.warning("Unable to apply avatars ( avatarJob )")
+          logging.warning(e)
+      await self.avatarEvent.wait()
+
+  # Switch out automatically if the current fronters have been switched in for longer than the timeout
+  # Sleeps until the current switch would time out, and is woken early whenever a new switch arrives
+  # Doesn't start until catchUp() has pulled the latest switches, the last switch on disc may have been replaced since
+  async def watchdogJob(self):
+    await self.readyEvent.wait()
+    while True:
+      self.switchEvent.clear()
+      wait = None
+      lastSwitch = self.state.lastSwitch
+
+      try:
+        # If anyone is currently switched in
+        if self.config["timeout"] and lastSwitch is not None and len(lastSwitch.get("members", [])) > 0:
+          deadline = datetime.datetime.fromisoformat(lastSwitch["timestamp"]) + datetime.timedelta(minutes=self.config["timeout"])
+          wait = (deadline - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+
+          if wait <= 0:
+            # Send a discord message
+            self.notifications.send("full", "Current fronters have been switched in more than " + str(self.config["timeout"]) + " minutes, switching out automatically.")
+
+            # Switch the current member(s) out, if it failed try again in a minute
+            wait = None if await self.switchOutNow() else 60
+      except Exception as e:
+        logging.warning("Unable to check the front timeout ( watchdogJob )")
+        logging.warning(e)
+        wait = 60
+
+      try:
+        await asyncio.wait_for(self.switchEvent.wait(), wait)
+      except asyncio.TimeoutError:
+        pass
+
+  # Switch out at each time of day in switchOutAt, e.g. ["03:00"], if anyone is switched in
+  async def scheduleJob(self):
+    times = []
+    for text in self.config.get("switchOutAt") or []:
+      try:
+        moment = datetime.time.fromisoformat(str(text))
+        times.append((moment.hour, moment.minute))
+      except ValueError:
+        logging.critical("switchOutAt times must be HH:MM, not " + str(text))
+    if len(times) == 0:
+      return
+    while True:
+      await asyncio.sleep(min(secondsUntilTime(hour, minute) for hour, minute in times))
+      lastSwitch = self.state.lastSwitch
+      if self.state.isReady() and lastSwitch is not None and len(lastSwitch.get("members", [])) > 0:
+        logging.info("Scheduled switch out")
+        try:
+          await self.switchOutNow()
+        except Exception as e:
+          logging.warning("Unable to switch out ( scheduleJob )")
+          logging.warning(e)
+      # Don't wake up again for the same minute
+      await asyncio.sleep(60)
+
+  async def run(self):
+    self.startup()
+    self.publishState()
+    jobs = [self.catchUpJob(), self.backfillJob(), self.pullJob(), self.refreshJob(), self.watchdogJob(), self.scheduleJob(), self.avatarJob(), self.notifications.run()]
+    if self.httpServer is not None:
+      jobs.append(self.httpServer.serve())
+    await asyncio.gather(*jobs)
+
+### Main Code ###
+
+# Run every system's daemon in the one event loop, with the control socket if there is one
+async def runAll(daemons, controlPath=None):
+  jobs = [daemon.run() for daemon in daemons]
+  if controlPath is not None:
+    jobs.append(controlServer(controlPath, daemons).serve())
+  await asyncio.gather(*jobs)
+
+# Seconds since the epoch for a time given on the command line, ISO 8601 in local time unless it has an offset, or now
+def parseTime(text):
+  if text is None or text == "now":
+    return time.time()
+  moment = datetime.datetime.fromisoformat(text)
+  if moment.tzinfo is None:
+    moment = moment.astimezone()
+  return moment.timestamp()
+
+# The history subcommand, prints who was fronting at a time or between two times from a system's local switch history
+# Only the data directory is read, so it works while the daemon is running and without reaching PluralKit
+def showHistory(args, configs):
+  configs = [i for i in configs if args.system is None or i["pluralkit"]["systemID"] == args.system]
+  if len(configs) == 0:
+    print("No system " + str(args.system) + " in the config")
+    return
+  dataLocation = os.path.expanduser(configs[0]["data"])
+  if not os.path.exists(dataLocation + "/pkSwitches.db"):
+    print("No switch history in " + dataLocation + " yet, run serve-whome to download it")
+    return
+  history = frontHistory(switchStore(dataLocation + "/pkSwitches.db").history())
+
+  if args.start is not None:
+    fronts = history.between(parseTime(args.start), parseTime(args.end))
+  else:
+    front = history.at(parseTime(args.at))
+    fronts = [front] if front is not None else []
+
+  if args.json:
+    print(json.dumps([{"start": toIso(start), "end": toIso(end), "members": list(members)} for start, end, members in fronts], indent=2))
+    return
+
+  if len(fronts) == 0:
+    print("No switches logged by then")
+    return
+  names = {}
+  if os.path.exists(dataLocation + "/pkMembers.json"):
+    with open(dataLocation + "/pkMembers.json", "r") as membersFile:
+      names = {member["id"]: member["name"] for member in json.load(membersFile)}
+  for start, end, members in fronts:
+    startText = datetime.datetime.fromtimestamp(start).strftime("%Y-%m-%d %H:%M")
+    endText = datetime.datetime.fromtimestamp(end).strftime("%Y-%m-%d %H:%M") if end is not None else "now"
+    print(startText + " - " + endText + "  " + (", ".join(names.get(pkid, pkid) for pkid in members) or "switched out"))
+
+def main():
+  # argparse setup
+  parser = argparse.ArgumentParser()
+
+  # avaible arguments
+  parser.add_argument("-r", "--rebuild", action="store_true", help="Rebuild all data")
+  parser.add_argument("-v", "--verbose", action="store_true", help="Enable info level logging")
+  parser.add_argument("-c", "--config", default="./config-serve-whome.yaml", help="Config file to use")
+
+  # Subcommands, without one the daemon is run
+  subcommands = parser.add_subparsers(dest="command")
+  historyParser = subcommands.add_parser("history", help="Show who was fronting at a time, or between two times, from the local switch history")
+  historyParser.add_argument("-s", "--system", help="System ID to look at, by default the first system in the config")
+  historyParser.add_argument("--at", help="Time to show the front at, e.g. 2024-05-14T15:00, local time unless an offset is given, default now")
+  historyParser.add_argument("--from", dest="start", help="Show every front from this time instead")
+  historyParser.add_argument("--to", dest="end", help="End of the time range, default now")
+  historyParser.add_argument("--json", action="store_true", help="Print json with UTC times and member ids")
+  controlParser = subcommands.add_parser("control", help="Send a command to the running server through its control socket")
+  controlParser.add_argument("action", choices=commands, help="switchout, refresh from PluralKit, rebuild from the local history, or status")
+  controlParser.add_argument("-s", "--system", help="Only this system ID, by default every system")
+  args = parser.parse_args()
+
+  # Load config, until logging is set up from it problems with it go to stderr
+  config = loadConfig(args.config)
+  if config is None:
+    exit()
+
+  # Logging setup
+  setupLogging(config, "serve-whome", args.verbose)
+
+  configs = systemConfigs(config)
+  problems = checkSystemConfigs(configs)
+  if problems:
+    for problem in problems:
+      logging.critical(problem)
+    exit()
+
+  if args.command == "control":
+    if controlPath(config) is None:
+      print("The control socket isn't enabled in " + args.config)
+      return
+    try:
+      reply = sendCommand(controlPath(config), args.action, args.system)
+    except (OSError, ValueError) as e:
+      print("Unable to reach the server: " + str(e))
+      exit(1)
+    print(json.dumps(reply, indent=2))
+    exit(0 if reply.get("ok") else 1)
+
+  if args.command == "history":
+    try:
+      showHistory(args, configs)
+    except ValueError as e:
+      parser.error(str(e))
+    return
+
+  # One client for every call to PluralKit, so connections and the rate limit are shared between all the systems
+  pluralkit = configs[0]["pluralkit"]
+  pk = pkClient(None, pluralkit.get("api", "https://api.pluralkit.me/v2"), pluralkit.get("timeout", 10), pluralkit.get("retries", 5))
+
+  # Spread the systems' polls across the update interval so they don't all hit the api in the same second
+  stagger = min(min(c["updateInterval"] for c in configs) * 60 / len(configs), 10)
+  daemons = [whomeDaemon(systemConfig, pk.forToken(systemConfig["pluralkit"]["token"]), args.rebuild, index * stagger) for index, systemConfig in enumerate(configs)]
+  asyncio.run(runAll(daemons, controlPath(config)))
@@ -0,0 +1,169 @@
+import hashlib
+import json
+import logging
+import os
+import time
+import requests
+
+# Pillow is optional, without it the full size avatar is used in place of a thumbnail
+try:
+  from PIL import Image, ImageOps
+except ImportError:
+  Image = None
+
+### Avatar cache ###
+# Members' avatars are downloaded into avatars/ in the data directory so dashboards don't have to fetch full size images
+# from PluralKit's CDN on every load, and keep working offline
+# Files are named after a hash of their contents, so they never change once written and can be cached forever, a new avatar
+# gets a new name. avatars/index.json remembers which file each url was saved as and the ETag it came with, so an avatar is
+# only downloaded again when the url changes or the CDN says it has changed, which is asked at most once every revalidate seconds
+
+# File extensions for the image types PluralKit accepts
+imageTypes = {"image/png": ".png", "image/jpeg": ".jpg", "image/gif": ".gif", "image/webp": ".webp"}
+
+# Largest avatar that will be downloaded, PluralKit's own limit is 1MB
+maxAvatarSize = 8 * 1024 * 1024
+
+class avatarCache:
+  def __init__(self, dataLocation, size=128, timeout=10, revalidate=86400):
+    self.location = dataLocation + "/avatars"
+    self.size = size
+    self.revalidate = revalidate
+    self.timeout = timeout
+    self.session = requests.Session()
+    self.session.headers.update({"User-Agent": "serve-whome"})
+
+    if not os.path.exists(self.location):
+      os.mkdir(self.location)
+
+    # url: { "etag", "file", "thumbnail", "checked" }
+    self.index = {}
+    if os.path.exists(self.location + "/index.json"):
+      try:
+        with open(self.location + "/index.json", "r") as indexFile:
+          self.index = json.load(indexFile)
+      except Exception as e:
+        logging.warning("avatarCache - unable to read index")
+        logging.warning(e)
+
+    if Image is None:
+      logging.info("avatarCache - Pillow isn't installed, full size avatars will be used instead of thumbnails")
+
+  def saveIndex(self):
+    with open(self.location + "/.index.json.tmp", "w") as indexFile:
+      indexFile.write(json.dumps(self.index))
+    os.replace(self.location + "/.index.json.tmp", self.location + "/index.json")
+
+  # Paths of a cached avatar relative to the data directory, ( thumbnail, full size ), or None if it isn't cached
+  def lookup(self, url):
+    entry = self.index.get(url)
+    if entry is None:
+      return None
+    return ("avatars/" + entry["thumbnail"], "avatars/" + entry["file"])
+
+  # Download any avatars that are new or have changed, and remove files no longer used by any of them
+  # Returns: True if any avatar changed
+  def sync(self, urls):
+    changed = False
+    indexBefore = json.dumps(self.index, sort_keys=True)
+    urls = set(i for i in urls if i)
+    for url in urls:
+      try:
+        changed = self.fetch(url) or changed
+      except Exception as e:
+        # Keep whatever copy there is, or fall back to the remote url, and try again next time
+        logging.warning("avatarCache - unable to download " + url)
+        logging.warning(e)
+
+    for url in list(self.index.keys()):
+      if url not in urls:
+        del self.index[url]
+        changed = True
+    if json.dumps(self.index, sort_keys=True) != indexBefore:
+      self.saveIndex()
+    if changed:
+      self.removeUnused()
+    return changed
+
+  # Download one avatar, sending the ETag from last time so an unchanged avatar is not sent again
+  # Returns: True if there is a new file for it
+  def fetch(self, url):
+    entry = self.index.get(url)
+    headers = {}
+    if entry is not None and os.path.exists(self.location + "/" + entry["file"]) and os.path.exists(self.location + "/" + entry["thumbnail"]):
+      # Saved before thumbnails could be made, make one from the copy already here
+      if entry["thumbnail"] == entry["file"] and Image is not None:
+        entry["thumbnail"] = self.makeThumbnail(os.path.splitext(entry["file"])[0], entry["file"])
+        return entry["thumbnail"] != entry["file"]
+      # Without an ETag there is no cheap way to ask if it changed, a new avatar comes with a new url anyway
+      if not entry.get("etag") or time.time() - entry.get("checked", 0) < self.revalidate:
+        return False
+      headers["If-None-Match"] = entry["etag"]
+
+    with self.session.get(url, headers=headers, timeout=self.timeout, stream=True) as r:
+      if r.status_code == 304:
+        entry["checked"] = time.time()
+        return False
+      r.raise_for_status()
+      contentType = r.headers.get("Content-Type", "").split(";")[0].strip()
+      if contentType not in imageTypes:
+        raise ValueError("not an image: " + contentType)
+      body = r.raw.read(maxAvatarSize + 1, decode_content=True)
+      if len(body) > maxAvatarSize:
+        raise ValueError("avatar is larger than " + str(maxAvatarSize) + " bytes")
+      etag = r.headers.get("ETag")
+
+    digest = hashlib.sha256(body).hexdigest()[:20]
+    name = digest + imageTypes[contentType]
+    self.writeFile(name, body)
+    thumbnail = self.makeThumbnail(digest, name)
+
+    newEntry = {"etag": etag, "file": name, "thumbnail": thumbnail, "checked": time.time()}
+    if entry is not None and entry["file"] == newEntry["file"] and entry["thumbnail"] == newEntry["thumbnail"]:
+      # Same picture, only the ETag moved on
+      self.index[url] = newEntry
+      return False
+    self.index[url] = newEntry
+    return True
+
+  # Make a square thumbnail, cropped to fill it, named after the same hash as the full size file
+  # Returns: the thumbnail's file name, the full size file if a thumbnail can't be made
+  def makeThumbnail(self, digest, name):
+    if Image is None:
+      return name
+    thumbnail = digest + "-" + str(self.size) + ".png"
+    if os.path.exists(self.location + "/" + thumbnail):
+      return thumbnail
+    try:
+      with Image.open(self.location + "/" + name) as image:
+        image = ImageOps.fit(image.convert("RGBA"), (self.size, self.size), Image.LANCZOS)
+        image.save(self.location + "/." + thumbnail + ".tmp", "PNG", optimize=True)
+      os.replace(self.location + "/." + thumbnail + ".tmp", self.location + "/" + thumbnail)
+      return thumbnail
+    except Exception as e:
+      logging.warning("avatarCache - unable to make a thumbnail of " + name)
+      logging.warning(e)
+      return name
+
+  def writeFile(self, name, body):
+    if os.path.exists(self.location + "/" + name):
+      return
+    with open(self.location + "/." + name + ".tmp", "wb") as outputFile:
+      outputFile.write(body)
+    os.replace(self.location + "/." + name + ".tmp", self.location + "/" + name)
+
+  # Delete image files that no avatar in the index uses any more
+  def removeUnused(self):
+    used = set()
+    for entry in self.index.values():
+      used.add(entry["file"])
+      used.add(entry["thumbnail"])
+    for name in os.listdir(self.location):
+      if name == "index.json" or name.startswith("."):
+        continue
+      if name not in used:
+        try:
+          os.remove(self.location + "/" + name)
+        except OSError as e:
+          logging.warning("avatarCache - unable to remove " + name)
+          logging.warning(e)
@@ -0,0 +1,21 @@
+import gzip
+
+# Brotli is optional, without it only gzip copies are made
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+### Compression ###
+# Used for the .gz and .br copies written next to the client views, and by the built in web server
+
+# gzip with the timestamp left out, so the same data always compresses to the same bytes
+def gzipBytes(data):
+  return gzip.compress(data, compresslevel=9, mtime=0)
+
+# Returns: the brotli compressed data, or None if brotli isn't installed
+# The best quality is slow, it is for files written once and read many times, anything done per publish should ask for less
+def brotliBytes(data, quality=11):
+  if brotli is None:
+    return None
+  return brotli.compress(data, quality=quality)
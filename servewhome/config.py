@@ -0,0 +1,58 @@
+import logging
+import yaml
+
+### Config loading ###
+# A config either describes one system at the top level, as it always has, or lists several under systems:
+# Each entry in systems: is laid over the top level settings, so anything shared (updateInterval, timeout, the pluralkit api
+# settings, stats) only has to be written once and each system just gives what is its own (pluralkit token and systemID,
+# data, groups, covers, discord, mqtt, http)
+
+# Load a yaml config file
+# Returns: the config as a dict, or None if it can't be read
+def loadConfig(path):
+  try:
+    with open(path, "r") as read_file:
+      return yaml.safe_load(read_file)
+  except Exception as e:
+    logging.critical("Settings file missing")
+    logging.critical(e)
+    return None
+
+# Split a config into one config per system
+# Returns: a list of config dicts, each shaped like a single system config
+def systemConfigs(config):
+  if not config.get("systems"):
+    return [config]
+
+  shared = {key: value for key, value in config.items() if key != "systems"}
+  configs = []
+  for entry in config["systems"]:
+    systemConfig = dict(shared)
+    systemConfig.update(entry)
+    # Merge the pluralkit block one level down, so api, timeout and retries can be set once for every system
+    systemConfig["pluralkit"] = dict(shared.get("pluralkit") or {})
+    systemConfig["pluralkit"].update(entry.get("pluralkit") or {})
+    # Systems can't share anything they write to, give each its own outbox unless one was set for it
+    if "outbox" not in (entry.get("discord") or {}):
+      systemConfig["discord"] = dict(systemConfig.get("discord") or {})
+      systemConfig["discord"]["outbox"] = "./outbox-serve-whome-" + systemConfig["pluralkit"]["systemID"] + ".json"
+    configs.append(systemConfig)
+
+  return configs
+
+# Check that no two systems would write over each other's files or listen on the same port
+# Returns: a list of problems, empty if the configs can run together
+def checkSystemConfigs(configs):
+  problems = []
+  seen = {}
+  for systemConfig in configs:
+    systemid = systemConfig["pluralkit"]["systemID"]
+    claims = [("data directory", systemConfig["data"]), ("outbox", systemConfig["discord"].get("outbox"))]
+    if "http" in systemConfig and systemConfig["http"]["enabled"]:
+      claims.append(("http port", (systemConfig["http"]["host"], systemConfig["http"]["port"])))
+    for kind, value in claims:
+      if (kind, value) in seen:
+        problems.append(systemid + " and " + seen[(kind, value)] + " share the same " + kind)
+      else:
+        seen[(kind, value)] = systemid
+  return problems
@@ -0,0 +1,90 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+
+### Control socket ###
+# A Unix socket the running server listens on, so switchout.py and admin commands act on the daemon that is already running
+# instead of starting a new interpreter and connection to PluralKit, and their changes are published straight away
+# Each request is one line of json, {"command": "switchout", "system": "abcde"}, answered with one line of json,
+# {"ok": true, "systems": {"abcde": {...}}}, leaving out system runs the command for every system
+# The socket can only be used by the user the server runs as
+
+commands = ["switchout", "refresh", "rebuild", "status"]
+
+class controlServer:
+  def __init__(self, path, daemons):
+    self.path = path
+    self.daemons = {daemon.systemid: daemon for daemon in daemons}
+
+  async def serve(self):
+    if os.path.exists(self.path):
+      # Left behind by a server that has stopped, unless something is still answering on it
+      try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+          probe.connect(self.path)
+        logging.critical("Control socket " + self.path + " is in use by another server, not listening on it")
+        return
+      except OSError:
+        os.remove(self.path)
+    server = await asyncio.start_unix_server(self.handle, self.path)
+    os.chmod(self.path, 0o600)
+    logging.info("Control socket listening on " + self.path)
+    async with server:
+      await server.serve_forever()
+
+  async def handle(self, reader, writer):
+    try:
+      reply = await self.run(await reader.readline())
+      writer.write((json.dumps(reply) + "\n").encode())
+      await writer.drain()
+    except ConnectionError:
+      pass
+    except Exception as e:
+      logging.warning("Control socket error")
+      logging.warning(e)
+    finally:
+      writer.close()
+
+  # Returns: the reply to a request
+  async def run(self, line):
+    try:
+      request = json.loads(line)
+    except ValueError:
+      return {"ok": False, "error": "requests are one line of json"}
+    if not isinstance(request, dict) or request.get("command") not in commands:
+      return {"ok": False, "error": "command must be one of " + ", ".join(commands)}
+    system = request.get("system")
+    if system is not None and system not in self.daemons:
+      return {"ok": False, "error": "no system " + str(system)}
+
+    logging.info("Control command " + request["command"] + " for " + (system or "every system"))
+    results = {}
+    for systemid, daemon in self.daemons.items():
+      if system is None or system == systemid:
+        results[systemid] = await daemon.control(request["command"])
+    return {"ok": all(result["ok"] for result in results.values()), "systems": results}
+
+# Where the control socket is, from the top level of the config, or None if it is turned off
+def controlPath(config):
+  control = config.get("control") or {}
+  if not control.get("enabled"):
+    return None
+  return os.path.expanduser(control.get("socket", "./serve-whome.sock"))
+
+# Send one command to a running server's control socket
+# Returns: the reply as a dictionary
+# Raises: OSError if there is no server listening on path
+def sendCommand(path, command, system=None, timeout=60):
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+    client.settimeout(timeout)
+    client.connect(path)
+    client.sendall((json.dumps({"command": command, "system": system}) + "\n").encode())
+    reply = b""
+    while not reply.endswith(b"\n"):
+      chunk = client.recv(65536)
+      if not chunk:
+        break
+      reply = reply + chunk
+  return json.loads(reply)
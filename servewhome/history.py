@@ -0,0 +1,99 @@
+import array
+import bisect
+import datetime
+
+### Front history ###
+# Answers "who was fronting at this time" and "who fronted between these times" from the local switch history
+# Switch times are kept sorted in an array next to a list of who switched in, so a point in time is found with a binary
+# search instead of a scan, and new switches are appended as they are seen without building everything again
+# Each front runs from one switch to the next, the last one is still going and has no end
+
+def toIso(epoch):
+  if epoch is None:
+    return None
+  return datetime.datetime.fromtimestamp(epoch, datetime.timezone.utc).isoformat(timespec="seconds").replace("+00:00", "Z")
+
+# Month a time falls in, in UTC, as YYYY-MM, which is also the name of its history file
+def monthOf(epoch):
+  return datetime.datetime.fromtimestamp(epoch, datetime.timezone.utc).strftime("%Y-%m")
+
+# ( start, end ) of a YYYY-MM month in seconds since the epoch
+def monthSpan(month):
+  start = datetime.datetime.strptime(month, "%Y-%m").replace(tzinfo=datetime.timezone.utc)
+  end = (start + datetime.timedelta(days=32)).replace(day=1)
+  return (start.timestamp(), end.timestamp())
+
+class frontHistory:
+  # history is ( epoch, [member ids] ) for every switch in chronological order, as given by switchStore.history()
+  def __init__(self, history=()):
+    self.epochs = array.array("d")
+    self.members = []
+    # Every front with the same members shares one tuple, most systems only have a few hundred different combinations
+    self.memberSets = {}
+    self.extend(history)
+
+  def __len__(self):
+    return len(self.epochs)
+
+  # Add switches newer than the last one already held, oldest first
+  # Raises: ValueError if a switch is older than the last one held, the history has to be built again to take it
+  def extend(self, history):
+    for epoch, members in history:
+      if len(self.epochs) > 0 and epoch < self.epochs[-1]:
+        raise ValueError("switch at " + toIso(epoch) + " is older than the last switch in the front history")
+      members = tuple(members)
+      self.epochs.append(epoch)
+      self.members.append(self.memberSets.setdefault(members, members))
+
+  # The front at index i as ( start, end or None, ( member ids ) )
+  def front(self, i):
+    return (self.epochs[i], self.epochs[i + 1] if i + 1 < len(self.epochs) else None, self.members[i])
+
+  # Returns: the front going on at epoch, or None if it is before the first switch
+  def at(self, epoch):
+    i = bisect.bisect_right(self.epochs, epoch) - 1
+    if i < 0:
+      return None
+    return self.front(i)
+
+  # Returns: every front that overlaps start to end, oldest first, the first may have started before start
+  def between(self, start, end):
+    first = max(bisect.bisect_right(self.epochs, start) - 1, 0)
+    last = bisect.bisect_left(self.epochs, end)
+    return [self.front(i) for i in range(first, last)]
+
+  # Every month from the one since falls in, or the first switch's, up to the current month, as YYYY-MM
+  # The last front is still going, so every month after the last switch has it in too
+  def months(self, since=None, now=None):
+    if len(self.epochs) == 0:
+      return []
+    if since is None:
+      since = self.epochs[0]
+    now = now if now is not None else datetime.datetime.now(datetime.timezone.utc).timestamp()
+    months = []
+    month = monthOf(max(since, self.epochs[0]))
+    lastMonth = monthOf(max(now, self.epochs[-1]))
+    while month <= lastMonth:
+      months.append(month)
+      month = monthOf(monthSpan(month)[1])
+    return months
+
+  # One month of fronts in a form that can be saved as history/YYYY-MM.json, fronts that cross into the months either
+  # side are included whole
+  def monthJson(self, month):
+    start, end = monthSpan(month)
+    return {
+      "month": month,
+      "start": toIso(start),
+      "end": toIso(end),
+      "fronts": [{"start": toIso(frontStart), "end": toIso(frontEnd), "members": list(members)} for frontStart, frontEnd, members in self.between(start, end)]
+    }
+
+  # The list of months that history/index.json gives, so clients know which files there are
+  def indexJson(self, now=None):
+    return {
+      "switches": len(self.epochs),
+      "first": toIso(self.epochs[0]) if len(self.epochs) > 0 else None,
+      "last": toIso(self.epochs[-1]) if len(self.epochs) > 0 else None,
+      "months": self.months(now=now)
+    }
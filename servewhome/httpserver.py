@@ -0,0 +1,233 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import urllib.parse
+from . import metrics
+from .compress import gzipBytes, brotliBytes
+
+### Built in web server ###
+# An optional replacement for serving the data directory with nginx, the json data sets are held in memory and served
+# with ETags so clients only download them when they have changed, and clients can wait on /wait or /events to hear
+# about a switch as soon as it has been seen instead of polling
+
+# Data sets served from memory, as /<name>.json
+documentNames = ["currentFronters", "memberList", "memberSeen", "lastSwitch", "stats", "viewWhome", "viewSystem"]
+
+# Other files that can be served straight out of the data directory
+staticTypes = {".html": "text/html; charset=utf-8", ".js": "text/javascript; charset=utf-8", ".css": "text/css; charset=utf-8"}
+
+# Front history files, history/YYYY-MM.json for each month and history/index.json listing them, see history.py
+historyName = re.compile(r"history/(\d{4}-\d{2}|index)\.json")
+
+# Cached avatars, from avatars/ in the data directory, their names change whenever their contents do so they never go stale
+avatarTypes = {".png": "image/png", ".jpg": "image/jpeg", ".gif": "image/gif", ".webp": "image/webp"}
+
+statusText = {200: "OK", 204: "No Content", 304: "Not Modified", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found", 405: "Method Not Allowed", 413: "Content Too Large"}
+
+# Largest request body accepted, dispatch events are a few kilobytes at most
+maxBodyLength = 1024 * 1024
+
+class whomeServer:
+  def __init__(self, host, port, dataLocation):
+    self.host = host
+    self.port = port
+    self.dataLocation = dataLocation
+    # name: ( body, gzipped body, brotli body or None, etag )
+    self.documents = {}
+    self.switchId = None
+    # Resolved and replaced every time a switch is published, long-poll and event stream clients wait on it
+    self.nextSwitch = None
+    # Path that takes POSTed PluralKit dispatch events, and the coroutine that handles them, see setWebhook()
+    self.webhookPath = None
+    self.webhookHandler = None
+    # Change journal served on /changes, see setJournal()
+    self.journal = None
+
+  # Accept POSTs to path and pass their bodies to handler, which returns the status to reply with
+  def setWebhook(self, path, handler):
+    self.webhookPath = "/" + path.strip("/")
+    self.webhookHandler = handler
+
+  # Serve the changes in journal on /changes?since=<version>
+  def setJournal(self, journal):
+    self.journal = journal
+
+  # Update a data set being served, digest is a hash of text and is used as the ETag
+  def publish(self, name, text, digest):
+    if name in self.documents and self.documents[name][3] == '"' + digest + '"':
+      return
+    body = text.encode()
+    self.documents[name] = (body, gzipBytes(body), brotliBytes(body, 5), '"' + digest + '"')
+
+  # Tell waiting clients that there has been a switch, called once currentFronters has been published for it
+  def publishSwitch(self, switchId):
+    if switchId == self.switchId:
+      return
+    self.switchId = switchId
+    if self.nextSwitch is not None and not self.nextSwitch.done():
+      self.nextSwitch.set_result(switchId)
+    self.nextSwitch = asyncio.get_running_loop().create_future()
+
+  async def serve(self):
+    if self.nextSwitch is None:
+      self.nextSwitch = asyncio.get_running_loop().create_future()
+    server = await asyncio.start_server(self.handle, self.host, self.port)
+    logging.info("Web server listening on " + str(self.host) + ":" + str(self.port))
+    async with server:
+      await server.serve_forever()
+
+### Request handling ###
+
+  async def handle(self, reader, writer):
+    try:
+      requestLine = (await reader.readline()).decode("latin-1").split()
+      headers = {}
+      while True:
+        line = (await reader.readline()).decode("latin-1")
+        if line in ("\r\n", "\n", ""):
+          break
+        key, _, value = line.partition(":")
+        headers[key.strip().lower()] = value.strip()
+
+      if len(requestLine) != 3:
+        await self.respond(writer, 400)
+      elif requestLine[0] == "POST" and self.webhookPath is not None and urllib.parse.urlsplit(requestLine[1]).path.rstrip("/") == self.webhookPath:
+        await self.receiveWebhook(reader, writer, headers)
+      elif requestLine[0] not in ("GET", "HEAD"):
+        await self.respond(writer, 405)
+      else:
+        url = urllib.parse.urlsplit(requestLine[1])
+        query = urllib.parse.parse_qs(url.query)
+        await self.route(writer, requestLine[0], url.path, query, headers)
+    except (ConnectionError, asyncio.IncompleteReadError):
+      pass
+    except Exception as e:
+      logging.warning("Web server error")
+      logging.warning(e)
+    finally:
+      writer.close()
+
+  async def route(self, writer, method, path, query, headers):
+    name = path.strip("/")
+
+    if name.endswith(".json") and name[:-5] in self.documents:
+      await self.sendDocument(writer, method, name[:-5], headers)
+
+    # Long-poll: returns currentFronters as soon as the switch differs from ?since=, or 204 after ?timeout= seconds
+    elif name == "wait":
+      since = query.get("since", [None])[0]
+      try:
+        timeout = min(float(query.get("timeout", ["55"])[0]), 300)
+      except ValueError:
+        timeout = 55
+      if since == self.switchId:
+        try:
+          await asyncio.wait_for(asyncio.shield(self.nextSwitch), timeout)
+        except asyncio.TimeoutError:
+          await self.respond(writer, 204)
+          return
+      await self.sendDocument(writer, method, "currentFronters", {})
+
+    # Counters, gauges and histograms for every system in the process, in the Prometheus text format
+    elif name == "metrics":
+      body = metrics.metrics.render().encode()
+      await self.respond(writer, 200, body if method == "GET" else b"", "text/plain; version=0.0.4; charset=utf-8", {"Cache-Control": "no-cache"}, len(body))
+
+    # Changes since ?since=, with the newest snapshot as well if the journal doesn't go back that far or since is left out
+    elif name == "changes" and self.journal is not None:
+      try:
+        since = int(query["since"][0]) if "since" in query else None
+      except ValueError:
+        await self.respond(writer, 400)
+        return
+      body = json.dumps(await asyncio.to_thread(self.journal.since, since)).encode()
+      extraHeaders = {"Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+      if "gzip" in headers.get("accept-encoding", ""):
+        body = gzipBytes(body)
+        extraHeaders["Content-Encoding"] = "gzip"
+      await self.respond(writer, 200, body if method == "GET" else b"", "application/json", extraHeaders, len(body))
+
+    # Server-sent events: sends currentFronters each time there is a switch
+    elif name == "events":
+      await self.streamEvents(writer)
+
+    elif name == "" or (os.path.basename(name) == name and os.path.splitext(name)[1] in staticTypes):
+      await self.sendStatic(writer, method, name or "whome.html", headers)
+
+    elif name.startswith("avatars/") and os.path.basename(name) == name[8:] and not name[8:].startswith(".") and os.path.splitext(name)[1] in avatarTypes:
+      await self.sendStatic(writer, method, name, headers, avatarTypes[os.path.splitext(name)[1]], "public, max-age=31536000, immutable")
+
+    # The month that is going on keeps changing, so these are checked each time like the pages
+    elif historyName.fullmatch(name):
+      await self.sendStatic(writer, method, name, headers, "application/json")
+
+    else:
+      await self.respond(writer, 404)
+
+  async def receiveWebhook(self, reader, writer, headers):
+    try:
+      length = int(headers.get("content-length", ""))
+    except ValueError:
+      await self.respond(writer, 400)
+      return
+    if length > maxBodyLength:
+      await self.respond(writer, 413)
+      return
+    body = await reader.readexactly(length)
+    await self.respond(writer, await self.webhookHandler(body))
+
+  async def sendDocument(self, writer, method, name, headers):
+    if name not in self.documents:
+      await self.respond(writer, 404)
+      return
+    body, gzipped, brotlied, etag = self.documents[name]
+    if headers.get("if-none-match") == etag:
+      await self.respond(writer, 304, extraHeaders={"ETag": etag})
+      return
+    extraHeaders = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    acceptEncoding = headers.get("accept-encoding", "")
+    if brotlied is not None and "br" in acceptEncoding:
+      body = brotlied
+      extraHeaders["Content-Encoding"] = "br"
+    elif "gzip" in acceptEncoding:
+      body = gzipped
+      extraHeaders["Content-Encoding"] = "gzip"
+    await self.respond(writer, 200, body if method == "GET" else b"", "application/json", extraHeaders, len(body))
+
+  async def sendStatic(self, writer, method, name, headers, contentType=None, cacheControl="no-cache"):
+    path = os.path.join(self.dataLocation, name)
+    if not os.path.isfile(path):
+      await self.respond(writer, 404)
+      return
+    etag = '"' + str(os.stat(path).st_mtime_ns) + '"'
+    if headers.get("if-none-match") == etag:
+      await self.respond(writer, 304, extraHeaders={"ETag": etag})
+      return
+    with open(path, "rb") as staticFile:
+      body = staticFile.read()
+    await self.respond(writer, 200, body if method == "GET" else b"", contentType or staticTypes[os.path.splitext(name)[1]], {"ETag": etag, "Cache-Control": cacheControl}, len(body))
+
+  async def streamEvents(self, writer):
+    writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n")
+    if "currentFronters" in self.documents:
+      writer.write(b"event: switch\ndata: " + self.documents["currentFronters"][0] + b"\n\n")
+    await writer.drain()
+    while True:
+      try:
+        await asyncio.wait_for(asyncio.shield(self.nextSwitch), 30)
+        writer.write(b"event: switch\ndata: " + self.documents["currentFronters"][0] + b"\n\n")
+      except asyncio.TimeoutError:
+        # Keep the connection from being dropped by anything in between
+        writer.write(b": keepalive\n\n")
+      await writer.drain()
+
+  async def respond(self, writer, status, body=b"", contentType=None, extraHeaders={}, length=None):
+    lines = ["HTTP/1.1 " + str(status) + " " + statusText[status], "Connection: close", "Content-Length: " + str(len(body) if length is None else length)]
+    if contentType is not None:
+      lines.append("Content-Type: " + contentType)
+    for key, value in extraHeaders.items():
+      lines.append(key + ": " + value)
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+    await writer.drain()
@@ -0,0 +1,179 @@
+import datetime
+import logging
+import os
+from .models import loads, dumps
+
+### Change journal ###
+# Every change to the journaled data sets is given the next version number and appended to journal/ in the data directory
+# as one line of json, so a client that has seen version n can fetch only what has changed since instead of whole files
+# Lists of records and dictionaries of members are recorded as just the records and fields that changed, anything else is
+# recorded whole. Segments are started afresh once they reach segmentBytes, with a snapshot of every data set at the
+# version the old one ended on, and only the newest keepSegments segments are kept, a client too far behind starts again
+# from the newest snapshot
+
+# Data sets that are journaled, and the field that identifies each record in the ones that are lists
+journalNames = ["pkSystem", "pkMembers", "pkGroups", "lastSwitch", "memberSeen", "memberList", "currentFronters"]
+recordKey = "id"
+
+# Work out what changed between two versions of a data set
+# Returns: ( set, remove ), records or members that are new or changed with only their changed fields ( removed fields are
+# None ), and the keys of ones that have gone, or None if the data set has to be recorded whole
+def diffDocument(old, new):
+  if isinstance(old, list) and isinstance(new, list) and all(isinstance(i, dict) and recordKey in i for i in old + new):
+    old = {i[recordKey]: i for i in old}
+    new = {i[recordKey]: i for i in new}
+  elif not (isinstance(old, dict) and isinstance(new, dict) and all(isinstance(i, dict) for i in list(old.values()) + list(new.values()))):
+    return None
+
+  changes = {}
+  for key, record in new.items():
+    if key not in old:
+      changes[key] = record
+    elif old[key] != record:
+      fields = {field: value for field, value in record.items() if old[key].get(field) != value or field not in old[key]}
+      fields.update({field: None for field in old[key] if field not in record})
+      changes[key] = fields
+  return (changes, [key for key in old if key not in new])
+
+class changeJournal:
+  def __init__(self, dataLocation, segmentBytes=1024 * 1024, keepSegments=8, fsync=False):
+    self.location = dataLocation + "/journal"
+    self.segmentBytes = segmentBytes
+    self.keepSegments = keepSegments
+    self.fsync = fsync
+    if not os.path.exists(self.location):
+      os.mkdir(self.location)
+
+    # First version in each segment and the version of each snapshot, oldest first, from the file names
+    self.segments = sorted(int(name[8:-7]) for name in os.listdir(self.location) if name.startswith("changes-") and name.endswith(".ndjson"))
+    self.snapshots = sorted(int(name[9:-5]) for name in os.listdir(self.location) if name.startswith("snapshot-") and name.endswith(".json"))
+    # Entries made since the last write()
+    self.pending = []
+    self.version = 0
+    if len(self.snapshots) > 0:
+      self.version = self.snapshots[-1]
+    if len(self.segments) > 0:
+      entries = self.readSegment(self.segments[-1])
+      self.version = max(self.version, entries[-1]["v"] if len(entries) > 0 else self.segments[-1] - 1)
+    # First version of the segment entries are being appended to, None to start a new one, as there is after a snapshot
+    self.segmentFirst = None
+    if len(self.segments) > 0 and (len(self.snapshots) == 0 or self.snapshots[-1] < self.version):
+      self.segmentFirst = self.segments[-1]
+
+  @staticmethod
+  def segmentName(first):
+    return "changes-" + str(first).zfill(12) + ".ndjson"
+
+  @staticmethod
+  def snapshotName(version):
+    return "snapshot-" + str(version).zfill(12) + ".json"
+
+  # Record a change to a data set, old is its previous contents or None if there weren't any
+  # Returns: the change's version, or None if nothing a client can see changed
+  def record(self, name, old, new):
+    entry = {"document": name}
+    diff = diffDocument(old, new) if old is not None else None
+    if diff is None:
+      entry["data"] = new
+    else:
+      if len(diff[0]) == 0 and len(diff[1]) == 0:
+        return None
+      entry["set"] = diff[0]
+      if len(diff[1]) > 0:
+        entry["remove"] = diff[1]
+    self.version = self.version + 1
+    entry = dict({"v": self.version, "time": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")}, **entry)
+    self.pending.append(entry)
+    return self.version
+
+  # Append everything recorded since the last write, then snapshot and start a new segment if this one is full or there has
+  # never been a snapshot, documents is called for { name: data } of every journaled data set as it is now
+  def write(self, documents):
+    if len(self.pending) == 0 and len(self.snapshots) > 0:
+      return
+    if len(self.pending) > 0:
+      if self.segmentFirst is None:
+        self.segmentFirst = self.pending[0]["v"]
+        self.segments.append(self.segmentFirst)
+      with open(self.location + "/" + self.segmentName(self.segmentFirst), "a") as segmentFile:
+        segmentFile.write("".join(dumps(entry) + "\n" for entry in self.pending))
+        if self.fsync:
+          segmentFile.flush()
+          os.fsync(segmentFile.fileno())
+      self.pending = []
+
+    full = self.segmentFirst is not None and os.path.getsize(self.location + "/" + self.segmentName(self.segmentFirst)) >= self.segmentBytes
+    if full or len(self.snapshots) == 0:
+      self.writeSnapshot(documents())
+      self.segmentFirst = None
+      self.compact()
+    self.writeIndex()
+
+  def writeSnapshot(self, documents):
+    name = self.snapshotName(self.version)
+    snapshot = {"v": self.version, "time": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"), "documents": documents}
+    self.writeFile(name, dumps(snapshot))
+    if self.version not in self.snapshots:
+      self.snapshots.append(self.version)
+
+  # Remove the oldest segments, and snapshots older than the oldest segment left, the newest snapshot is always kept
+  def compact(self):
+    while len(self.segments) > self.keepSegments:
+      self.removeFile(self.segmentName(self.segments.pop(0)))
+    oldest = self.segments[0] - 1 if len(self.segments) > 0 else self.snapshots[-1]
+    for version in [i for i in self.snapshots[:-1] if i < oldest]:
+      self.snapshots.remove(version)
+      self.removeFile(self.snapshotName(version))
+
+  # journal/index.json, so clients reading the files directly know which there are
+  def writeIndex(self):
+    index = {
+      "v": self.version,
+      "segments": [{"file": self.segmentName(i), "first": i} for i in self.segments],
+      "snapshots": [{"file": self.snapshotName(i), "v": i} for i in self.snapshots]
+    }
+    self.writeFile("index.json", dumps(index))
+
+  def writeFile(self, name, text):
+    with open(self.location + "/." + name + ".tmp", "w") as outputFile:
+      outputFile.write(text)
+      if self.fsync:
+        outputFile.flush()
+        os.fsync(outputFile.fileno())
+    os.replace(self.location + "/." + name + ".tmp", self.location + "/" + name)
+
+  def removeFile(self, name):
+    try:
+      os.remove(self.location + "/" + name)
+    except OSError as e:
+      logging.warning("changeJournal - unable to remove " + name)
+      logging.warning(e)
+
+  # Entries in one segment, a line still being written is left out
+  def readSegment(self, first):
+    entries = []
+    try:
+      with open(self.location + "/" + self.segmentName(first), "r") as segmentFile:
+        for line in segmentFile:
+          if line.endswith("\n"):
+            entries.append(loads(line))
+    except (OSError, ValueError) as e:
+      logging.warning("changeJournal - unable to read " + self.segmentName(first))
+      logging.warning(e)
+    return entries
+
+  # What a client that has seen version needs to catch up, everything written so far after it or, if the journal doesn't go
+  # back that far, the newest snapshot and everything after that
+  # Returns: { "v": current version, "entries": [ ... ] } with "snapshot" added when the client has to start again
+  def since(self, version):
+    segments = list(self.segments)
+    snapshots = list(self.snapshots)
+    reply = {"v": self.version - len(self.pending)}
+    if version is None or version > reply["v"] or len(segments) == 0 or version < segments[0] - 1:
+      if len(snapshots) == 0:
+        return dict(reply, entries=[])
+      with open(self.location + "/" + self.snapshotName(snapshots[-1]), "r") as snapshotFile:
+        reply["snapshot"] = loads(snapshotFile.read())
+      version = snapshots[-1]
+    reply["entries"] = [entry for first, following in zip(segments, segments[1:] + [None]) if following is None or following - 1 > version for entry in self.readSegment(first) if entry["v"] > version]
+    return reply
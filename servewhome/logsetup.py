@@ -0,0 +1,120 @@
+import atexit
+import datetime
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import time
+
+### Logging ###
+# Log calls only put the record on a queue, a listener thread writes it out, so polls, dispatch events and notifications
+# never wait on the log file. The file is rotated by size or by time and rotated files are gzipped, by the listener thread
+# Lines are json by default, with system, operation, duration and switchId given to a log call with extra= as their own fields
+# Each module is a component, pkclient, state, notify and so on, and can be given its own level under logging: components:
+
+# Fields given with extra= that are kept in json lines
+extraFields = ["system", "operation", "duration", "switchId"]
+
+class jsonFormatter(logging.Formatter):
+  def format(self, record):
+    entry = {
+      "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+      "level": record.levelname.lower(),
+      "component": record.module,
+      "message": record.getMessage()
+    }
+    for field in extraFields:
+      if getattr(record, field, None) is not None:
+        entry[field] = getattr(record, field)
+    return json.dumps(entry, default=str)
+
+# Lets a record through if it is at or above the level of the module that logged it, or the default level
+class componentFilter(logging.Filter):
+  def __init__(self, level, components):
+    super().__init__()
+    self.level = level
+    self.components = components
+
+  def filter(self, record):
+    return record.levelno >= self.components.get(record.module, self.level)
+
+### Rotation ###
+
+def compressedName(name):
+  return name + ".gz"
+
+# Used in place of renaming the file being rotated out
+def compressFile(source, destination):
+  with open(source, "rb") as sourceFile, gzip.open(destination, "wb") as destinationFile:
+    shutil.copyfileobj(sourceFile, destinationFile)
+  os.remove(source)
+
+### Setup ###
+
+# Returns: the level called text, e.g. "info", or None if there isn't one
+def parseLevel(text):
+  level = logging.getLevelName(str(text).upper())
+  return level if isinstance(level, int) else None
+
+# Log to log-<name>.log, using the settings under logging: in the config, verbose lowers the default level to info
+# Returns: the listener thread writing the file, it is stopped, writing out anything still queued, when the program exits
+def setupLogging(config, name, verbose=False):
+  settings = (config or {}).get("logging") or {}
+  problems = []
+
+  level = parseLevel(settings.get("level", "warning"))
+  if level is None:
+    problems.append("Unknown log level " + str(settings.get("level")) + ", using warning")
+    level = logging.WARNING
+  if verbose:
+    level = min(level, logging.INFO)
+  components = {}
+  for component, text in (settings.get("components") or {}).items():
+    if parseLevel(text) is None:
+      problems.append("Unknown log level " + str(text) + " for " + str(component) + ", ignoring it")
+    else:
+      components[str(component)] = parseLevel(text)
+
+  path = os.path.join(os.path.expanduser(str(settings.get("directory", "."))), "log-" + name + ".log")
+  if settings.get("rotate", "size") == "time":
+    try:
+      fileHandler = logging.handlers.TimedRotatingFileHandler(path, when=settings.get("when", "midnight"), backupCount=settings.get("backupCount", 7), encoding="utf-8")
+    except ValueError as e:
+      problems.append("Unable to rotate the log at " + str(settings.get("when")) + ", rotating at midnight: " + str(e))
+      fileHandler = logging.handlers.TimedRotatingFileHandler(path, when="midnight", backupCount=settings.get("backupCount", 7), encoding="utf-8")
+  else:
+    if settings.get("rotate", "size") != "size":
+      problems.append("logging rotate must be size or time, not " + str(settings.get("rotate")) + ", rotating by size")
+    fileHandler = logging.handlers.RotatingFileHandler(path, maxBytes=settings.get("maxBytes", 10 * 1024 * 1024), backupCount=settings.get("backupCount", 7), encoding="utf-8")
+  if settings.get("compress", True):
+    fileHandler.namer = compressedName
+    fileHandler.rotator = compressFile
+  if settings.get("format", "json") == "text":
+    fileHandler.setFormatter(logging.Formatter("%(asctime)s : %(message)s"))
+  else:
+    fileHandler.setFormatter(jsonFormatter())
+
+  # Filtered before queueing, so records nobody wants are dropped straight away in the thread that made them
+  queueHandler = logging.handlers.QueueHandler(queue.SimpleQueue())
+  queueHandler.addFilter(componentFilter(level, components))
+  root = logging.getLogger()
+  root.addHandler(queueHandler)
+  root.setLevel(min([level] + list(components.values())))
+
+  listener = logging.handlers.QueueListener(queueHandler.queue, fileHandler)
+  listener.start()
+  atexit.register(listener.stop)
+
+  for problem in problems:
+    logging.critical(problem)
+  return listener
+
+# Log how long an operation took, started is from time.perf_counter()
+# fields are any of system and switchId, json lines keep them, the operation and the duration in seconds as their own fields
+def logOperation(message, operation, started, level=logging.INFO, **fields):
+  duration = round(time.perf_counter() - started, 3)
+  # stacklevel so the component is the caller's module rather than this one
+  logging.log(level, message + " ( " + operation + ", " + str(duration) + "s )", extra=dict(fields, operation=operation, duration=duration), stacklevel=2)
@@ -0,0 +1,62 @@
+
+### Discord message sending ###
+# Used for notifiying of switches and also for server startup
+# Last seen and headspace times come from the state's per switch cache, so building a message is only lookups
+def messageShort(state):
+  index = len(state.currentFronters["members"])
+  message = "Hi, "
+  
+  for member in state.currentFronters["members"]:
+    index = index - 1
+    
+    if member["visible"]:
+      if member["displayName"]:
+        message = message + member["displayName"]
+      else:
+        message = message + member["name"]
+      if member["pronouns"] is not None:
+        message = message + " ( " + member["pronouns"] + " )"
+    else:
+      message = message + state.pkSystem.name
+      if state.pkSystem.pronouns is not None:
+        message = message + " ( " + state.pkSystem.pronouns + " )"
+
+    if "cardSuit" in member and member["cardSuit"] is not None:
+      message = message + " " + member["cardSuit"]
+
+    match index:
+      case 0: message = message
+      case 1: message = message + ", and "
+      case _: message = message + ", "
+      
+  return message
+
+def messageLong(state):
+  index = len(state.currentFronters["members"])
+  message = "Hi, "
+
+  for member in state.currentFronters["members"]:
+
+    index = index - 1
+    if member["displayName"]:
+      message = message + member["displayName"]
+    else:
+      message = message + member["name"]
+
+    if member["pronouns"] is not None:
+      message = message + " ( " + member["pronouns"] + " )"
+
+    lastSeen = state.lastSeenValues(member["id"])
+    message = message + "\nYou last fronted:\n" + lastSeen["realTime"] + " ago"
+
+    message = message + "\non: " + lastSeen["lastOut"]
+
+    message = message + "\nIn headpsace time:\n" + lastSeen["headspaceTime"]
+
+    if index == 0:
+      message = message + "\n---\n"
+      message = message + "Current headspace time:\n" + state.headspaceNow()
+    else:
+      message = message + "\n---\n"
+
+  return message
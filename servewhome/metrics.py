@@ -0,0 +1,186 @@
+import bisect
+import json
+import math
+import threading
+import time
+
+### Metrics ###
+# Counters, gauges and histograms for the hot paths, served in the Prometheus text format on /metrics by the built in web
+# server and optionally written to metrics.json in the data directory
+# Every metric lives in the one process wide registry below, so systems are told apart by their system label
+
+# Default histogram buckets in seconds, from a fast local write up to a PluralKit call that has been retried a few times
+defaultBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class metric:
+  kind = None
+
+  def __init__(self, registry, name, help, labels=()):
+    self.registry = registry
+    self.name = name
+    self.help = help
+    self.labelNames = tuple(labels)
+    # label values tuple: value
+    self.values = {}
+
+  def key(self, labels):
+    return tuple(str(labels.get(i, "")) for i in self.labelNames)
+
+  # Samples as ( name suffix, label pairs, value )
+  def samples(self):
+    for key, value in self.values.items():
+      yield "", list(zip(self.labelNames, key)), value
+
+class counter(metric):
+  kind = "counter"
+
+  def inc(self, amount=1, **labels):
+    key = self.key(labels)
+    with self.registry.lock:
+      self.values[key] = self.values.get(key, 0) + amount
+
+class gauge(metric):
+  kind = "gauge"
+
+  def set(self, value, **labels):
+    key = self.key(labels)
+    with self.registry.lock:
+      self.values[key] = value
+
+  def inc(self, amount=1, **labels):
+    key = self.key(labels)
+    with self.registry.lock:
+      self.values[key] = self.values.get(key, 0) + amount
+
+class histogram(metric):
+  kind = "histogram"
+
+  def __init__(self, registry, name, help, labels=(), buckets=defaultBuckets):
+    super().__init__(registry, name, help, labels)
+    self.buckets = tuple(buckets)
+
+  def observe(self, value, **labels):
+    key = self.key(labels)
+    with self.registry.lock:
+      # [ count in each bucket, count, sum ], the counts aren't cumulative until they are rendered
+      entry = self.values.setdefault(key, [[0] * len(self.buckets), 0, 0.0])
+      index = bisect.bisect_left(self.buckets, value)
+      if index < len(self.buckets):
+        entry[0][index] = entry[0][index] + 1
+      entry[1] = entry[1] + 1
+      entry[2] = entry[2] + value
+
+  # Time a block of code: with metrics.pullSeconds.time(system=systemid):
+  def time(self, **labels):
+    return timer(self, labels)
+
+  def samples(self):
+    for key, (counts, count, total) in self.values.items():
+      labels = list(zip(self.labelNames, key))
+      cumulative = 0
+      for bound, bucketCount in zip(self.buckets, counts):
+        cumulative = cumulative + bucketCount
+        yield "_bucket", labels + [("le", formatValue(bound))], cumulative
+      yield "_bucket", labels + [("le", "+Inf")], count
+      yield "_count", labels, count
+      yield "_sum", labels, total
+
+class timer:
+  def __init__(self, histogram, labels):
+    self.histogram = histogram
+    self.labels = labels
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc):
+    self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+    return False
+
+def formatValue(value):
+  if isinstance(value, float) and math.isinf(value):
+    return "+Inf"
+  if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+    return str(int(value))
+  return repr(value) if isinstance(value, float) else str(value)
+
+def escapeLabel(value):
+  return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+class registry:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.metrics = []
+
+  def counter(self, name, help, labels=()):
+    return self.add(counter(self, name, help, labels))
+
+  def gauge(self, name, help, labels=()):
+    return self.add(gauge(self, name, help, labels))
+
+  def histogram(self, name, help, labels=(), buckets=defaultBuckets):
+    return self.add(histogram(self, name, help, labels, buckets))
+
+  def add(self, metric):
+    self.metrics.append(metric)
+    return metric
+
+  # Everything in the Prometheus text exposition format
+  def render(self):
+    lines = []
+    with self.lock:
+      for metric in self.metrics:
+        lines.append("# HELP " + metric.name + " " + metric.help)
+        lines.append("# TYPE " + metric.name + " " + metric.kind)
+        for suffix, labels, value in metric.samples():
+          labelText = ",".join(name + '="' + escapeLabel(value) + '"' for name, value in labels)
+          lines.append(metric.name + suffix + ("{" + labelText + "}" if labelText else "") + " " + formatValue(value))
+    return "\n".join(lines) + "\n"
+
+  # Everything as json, if system is given samples labelled with a different system are left out
+  def toJson(self, system=None):
+    output = {}
+    with self.lock:
+      for metric in self.metrics:
+        samples = []
+        for suffix, labels, value in metric.samples():
+          labels = dict(labels)
+          if system is not None and labels.get("system", system) != system:
+            continue
+          samples.append({"name": metric.name + suffix, "labels": labels, "value": value})
+        output[metric.name] = {"type": metric.kind, "help": metric.help, "samples": samples}
+    return json.dumps(output)
+
+metrics = registry()
+
+### Metrics recorded ###
+
+# PluralKit api, endpoint has the system id taken out e.g. /systems/:id/switches
+pkRequests = metrics.counter("whome_pk_requests_total", "Requests made to the PluralKit api, by response status", ["method", "endpoint", "status"])
+pkRequestSeconds = metrics.histogram("whome_pk_request_seconds", "Time taken by each request to the PluralKit api, retries are timed separately", ["method", "endpoint"])
+pkRetries = metrics.counter("whome_pk_retries_total", "Requests to the PluralKit api that were retried, by reason", ["reason"])
+pkRateLimitWaitSeconds = metrics.counter("whome_pk_ratelimit_wait_seconds_total", "Time spent waiting on the shared rate limiter before a request could be made")
+
+# Polling
+pullSeconds = metrics.histogram("whome_pull_seconds", "Time taken by each poll for new switches", ["system"])
+pullErrors = metrics.counter("whome_pull_errors_total", "Polls for new switches that failed", ["system"])
+lastPullTimestamp = metrics.gauge("whome_last_pull_timestamp_seconds", "Unix time of the last poll that finished, alert on time() minus this", ["system"])
+switchesSeen = metrics.counter("whome_switches_seen_total", "New switches picked up by polling", ["system"])
+switchLagSeconds = metrics.histogram("whome_switch_lag_seconds", "Time between a switch being logged in PluralKit and being seen here", ["system"], (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600))
+updateMemberSeenSeconds = metrics.histogram("whome_update_member_seen_seconds", "Time taken to apply new switches to memberSeen", ["system"])
+
+# Switch history backfill
+backfillSwitches = metrics.gauge("whome_backfill_switches", "Switches in the local history", ["system"])
+backfillPercent = metrics.gauge("whome_backfill_percent", "How much of the time since the system was created the local history covers", ["system"])
+
+# Data files
+saveSeconds = metrics.histogram("whome_save_seconds", "Time taken to serialise and hash a data file", ["system", "name"])
+writeSeconds = metrics.histogram("whome_write_seconds", "Time taken to write a changed data file to disc", ["system", "name"])
+filesWritten = metrics.counter("whome_files_written_total", "Data files written to disc because they changed", ["system", "name"])
+writeErrors = metrics.counter("whome_write_errors_total", "Data files that couldn't be written", ["system", "name"])
+
+# Discord
+messageSends = metrics.counter("whome_message_sends_total", "Batches of messages sent to Discord, by result", ["system", "sink", "result"])
+messageSendSeconds = metrics.histogram("whome_message_send_seconds", "Time taken to post a batch of messages to Discord", ["system", "sink"])
+outboxLength = metrics.gauge("whome_outbox_messages", "Messages waiting in the outbox", ["system"])
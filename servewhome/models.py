@@ -0,0 +1,79 @@
+import json
+
+# orjson is optional, it parses and writes json several times faster than the json module
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+### Models ###
+# PluralKit sends every member and group with descriptions, banners, colours, privacy settings and more, but only a few of
+# their fields are ever used. The payloads are saved to the data directory as they came, and only these models, holding
+# just the fields that are used, are kept in memory
+# Member ids are normalised once here, PluralKit sometimes adds trailing spaces to them
+
+### json ###
+
+def loads(data):
+  if orjson is not None:
+    return orjson.loads(data)
+  return json.loads(data)
+
+# Returns: text, the same data always gives the same text
+def dumps(data):
+  if orjson is not None:
+    return orjson.dumps(data).decode()
+  return json.dumps(data)
+
+### PluralKit data ###
+
+class systemModel:
+  __slots__ = ("id", "uuid", "name", "pronouns", "created")
+
+  def __init__(self, data):
+    self.id = data["id"].strip()
+    self.uuid = data.get("uuid")
+    self.name = data.get("name")
+    self.pronouns = data.get("pronouns")
+    self.created = data.get("created")
+
+class memberModel:
+  __slots__ = ("id", "uuid", "name", "displayName", "pronouns", "avatarUrl", "tag", "visible")
+
+  def __init__(self, data):
+    self.id = data["id"].strip()
+    self.uuid = data.get("uuid")
+    self.name = data["name"]
+    # The display name if there is one, otherwise the name
+    self.displayName = data["display_name"] if data.get("display_name") is not None else data["name"]
+    self.pronouns = data.get("pronouns")
+    self.avatarUrl = data.get("avatar_url")
+
+    # The first proxy tag suffix
+    self.tag = ""
+    for tag in data.get("proxy_tags") or []:
+      if tag.get("suffix"):
+        self.tag = tag["suffix"]
+        break
+
+    # Privacy is only sent to the system's own token, without it only public members are sent at all
+    self.visible = (data.get("privacy") or {}).get("visibility", "public") == "public"
+
+class groupModel:
+  __slots__ = ("id", "uuid", "name", "members")
+
+  def __init__(self, data):
+    self.id = data["id"].strip()
+    self.uuid = data.get("uuid")
+    self.name = data["name"]
+    # Member uuids, only sent when groups are fetched with their members
+    self.members = tuple(data.get("members") or ())
+
+# Switches are already small, they are kept as dictionaries of just the id, timestamp and member ids, as saved in lastSwitch
+# Members may be given as ids or, in the reply to logging a switch, as member objects
+def switchFromJson(data):
+  return {
+    "id": data["id"],
+    "timestamp": data["timestamp"],
+    "members": [(pkid["id"] if isinstance(pkid, dict) else pkid).strip() for pkid in data["members"]]
+  }
@@ -0,0 +1,103 @@
+import json
+import logging
+
+try:
+  import paho.mqtt.client as mqtt
+except ImportError:
+  mqtt = None
+
+### MQTT publishing ###
+# Keeps one connection to the broker open and pushes the current front to it, with Home Assistant discovery configs so
+# the sensors appear on their own, see notes/mqtt.md for the topics
+# State is published retained, and only for the values that have changed since they were last published
+
+# Sensors published for the first fronter, as field: ( name, Home Assistant device class )
+sensors = {
+  "front": ("Front", None),
+  "pronouns": ("Pronouns", None),
+  "lastin": ("Last In", "timestamp"),
+  "lastseen": ("Last Seen", "timestamp")
+}
+
+class mqttPublisher:
+  # client is made and connected from mqttConfig unless one is passed in, anything with paho's publish(), is_connected() and
+  # on_connect will do, e.g. the stub in bench/mqttcheck.py
+  def __init__(self, mqttConfig, systemId, client=None):
+    self.systemId = systemId
+    self.discoveryPrefix = mqttConfig.get("discoveryPrefix", "homeassistant")
+    self.systemName = None
+    self.published = {}
+
+    self.client = client if client is not None else self.connect(mqttConfig)
+    self.client.on_connect = self.onConnect
+
+  # Make a paho client for the broker in mqttConfig
+  def connect(self, mqttConfig):
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id="serve-whome-" + self.systemId)
+    if mqttConfig.get("user"):
+      client.username_pw_set(mqttConfig["user"], mqttConfig.get("pass"))
+    client.on_connect = self.onConnect
+    client.reconnect_delay_set(1, 120)
+    # Connect in the background, paho's network thread takes care of reconnecting if the broker goes away
+    client.connect_async(mqttConfig["server"], mqttConfig.get("port", 1883))
+    client.loop_start()
+    return client
+
+  def stateTopic(self, field):
+    return "whome-" + self.systemId + "/" + field
+
+  # On every (re)connect send the discovery configs, then everything we know, as the broker may have lost retained messages
+  def onConnect(self, client, userdata, flags, reasonCode, properties):
+    if reasonCode.is_failure:
+      logging.warning("MQTT connection refused: " + str(reasonCode))
+      return
+    logging.info("Connected to MQTT broker")
+    # Discovery needs the system name, if it isn't known yet it is sent by the first update
+    if self.systemName is not None:
+      self.publishDiscovery()
+    for field, value in list(self.published.items()):
+      self.client.publish(self.stateTopic(field), value, retain=True)
+
+  def publishDiscovery(self):
+    for field, (name, deviceClass) in sensors.items():
+      payload = {
+        "name": name,
+        "state_topic": self.stateTopic(field),
+        "unique_id": "whome-" + self.systemId + "-" + field,
+        "device": {
+          "identifiers": ["whome-" + self.systemId],
+          "name": "WhoMe: " + self.systemName,
+          "manufacturer": "github/barefootselkie",
+          "model": "Serve-WhoMe"
+        }
+      }
+      if deviceClass is not None:
+        payload["device_class"] = deviceClass
+      self.client.publish(self.discoveryPrefix + "/sensor/whome-" + self.systemId + "-" + field + "/config", json.dumps(payload), retain=True)
+
+  # Publish the state from a currentFronters data set, only the fields that have changed are sent
+  def update(self, currentFronters):
+    # The device name comes from the system name, so resend discovery if that has changed
+    if currentFronters["system"]["name"] != self.systemName:
+      self.systemName = currentFronters["system"]["name"]
+      if self.client.is_connected():
+        self.publishDiscovery()
+
+    members = currentFronters["members"]
+    if len(members) == 0:
+      state = {"front": "Switched out", "pronouns": "None", "lastin": "None", "lastseen": "None"}
+    else:
+      # Members who aren't public show up as the system
+      names = [i["displayName"] if i["visible"] else currentFronters["system"]["name"] for i in members]
+      first = members[0]
+      state = {
+        "front": ", ".join(names),
+        "pronouns": (first["pronouns"] if first["visible"] else currentFronters["system"]["pronouns"]) or "None",
+        "lastin": first["lastIn"],
+        "lastseen": first["lastOut"]
+      }
+
+    for field, value in state.items():
+      if self.published.get(field) != value:
+        self.published[field] = value
+        self.client.publish(self.stateTopic(field), value, retain=True)
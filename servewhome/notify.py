@@ -0,0 +1,149 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+import requests
+from . import metrics
+from .logsetup import logOperation
+
+### Notifications ###
+# Messages are put in an outbox and sent by a background job, so nothing that produces a message ever waits on Discord
+# The outbox is saved to disc so queued messages survive a restart, messages of the same kind (e.g. switch announcements)
+# replace any that haven't been sent yet so a burst of switches only sends the latest, and anything else waiting for the
+# same sink is sent together in one message
+
+# Raised by a sink when it has been rate limited, retryAfter is in seconds
+class rateLimited(Exception):
+  def __init__(self, retryAfter):
+    super().__init__("rate limited for " + str(retryAfter) + "s")
+    self.retryAfter = retryAfter
+
+### Sinks ###
+
+class discordWebhook:
+  # Discord won't take messages longer than this
+  maxLength = 2000
+
+  def __init__(self, serverID, token, timeout=10):
+    self.url = "https://discord.com/api/webhooks/" + str(serverID) + "/" + str(token)
+    self.timeout = timeout
+
+  # Post a message to the webhook
+  # Returns: seconds to wait before anything else is sent, from Discord's rate limit headers
+  def post(self, session, text):
+    r = session.post(self.url, json={"content": text}, timeout=self.timeout)
+    if r.status_code == 429:
+      try:
+        raise rateLimited(float(r.json()["retry_after"]))
+      except (ValueError, KeyError):
+        raise rateLimited(float(r.headers.get("Retry-After", 5)))
+    r.raise_for_status()
+    if r.headers.get("X-RateLimit-Remaining") == "0":
+      return float(r.headers.get("X-RateLimit-Reset-After", 1))
+    return 0
+
+### Outbox ###
+
+class notifier:
+  # system is only used to label this outbox's metrics
+  def __init__(self, sinks, outboxPath, coalesceDelay=5, retries=8, system=""):
+    self.sinks = sinks
+    self.system = system
+    self.outboxPath = outboxPath
+    self.coalesceDelay = coalesceDelay
+    self.retries = retries
+    self.session = requests.Session()
+    self.wakeup = asyncio.Event()
+
+    # Pick up anything that was waiting to be sent when we last stopped
+    self.outbox = []
+    if os.path.exists(outboxPath):
+      try:
+        with open(outboxPath, "r") as outboxFile:
+          self.outbox = json.load(outboxFile)
+        logging.info(str(len(self.outbox)) + " messages waiting in the outbox")
+      except Exception as e:
+        logging.warning("notifier - unable to read outbox")
+        logging.warning(e)
+    metrics.outboxLength.set(len(self.outbox), system=system)
+
+  def saveOutbox(self):
+    metrics.outboxLength.set(len(self.outbox), system=self.system)
+    try:
+      with open(self.outboxPath + ".tmp", "w") as outboxFile:
+        outboxFile.write(json.dumps(self.outbox))
+      os.replace(self.outboxPath + ".tmp", self.outboxPath)
+    except Exception as e:
+      logging.warning("notifier - unable to save outbox")
+      logging.warning(e)
+
+  # Queue a message, never blocks
+  # kind: messages of the same kind for the same sink replace each other if the older one hasn't been sent yet
+  def send(self, sink, text, kind=None):
+    if sink not in self.sinks:
+      logging.info("notifier - no sink called " + sink + ", dropping message")
+      return
+    if kind is not None:
+      self.outbox = [i for i in self.outbox if not (i["sink"] == sink and i["kind"] == kind)]
+    self.outbox.append({"sink": sink, "text": text, "kind": kind, "attempts": 0})
+    self.saveOutbox()
+    self.wakeup.set()
+
+  # Take the next batch to send, the oldest message along with any others for the same sink that fit in one message
+  def nextBatch(self):
+    sink = self.outbox[0]["sink"]
+    batch = []
+    length = 0
+    for message in self.outbox:
+      if message["sink"] != sink:
+        continue
+      if len(batch) > 0 and length + 2 + len(message["text"]) > self.sinks[sink].maxLength:
+        break
+      batch.append(message)
+      length = length + 2 + len(message["text"])
+    return sink, batch
+
+  # Background job that sends everything in the outbox
+  async def run(self):
+    while True:
+      if len(self.outbox) == 0:
+        self.wakeup.clear()
+        await self.wakeup.wait()
+        # Give anything else that is about to be queued a chance to coalesce with this
+        await asyncio.sleep(self.coalesceDelay)
+        continue
+
+      sink, batch = self.nextBatch()
+      wait = 0
+      started = time.perf_counter()
+      try:
+        logging.info("Sending " + str(len(batch)) + " messages to " + sink)
+        wait = await asyncio.to_thread(self.sinks[sink].post, self.session, "\n\n".join(i["text"] for i in batch))
+        metrics.messageSends.inc(system=self.system, sink=sink, result="sent")
+        logOperation("Sent " + str(len(batch)) + " messages to " + sink, "send", started, system=self.system)
+        sent = set(id(i) for i in batch)
+        self.outbox = [i for i in self.outbox if id(i) not in sent]
+      except rateLimited as e:
+        metrics.messageSends.inc(system=self.system, sink=sink, result="ratelimited")
+        logging.info("notifier - " + sink + " " + str(e))
+        wait = e.retryAfter
+      except Exception as e:
+        metrics.messageSends.inc(system=self.system, sink=sink, result="failed")
+        logging.warning("notifier - unable to send to " + sink)
+        logging.warning(e)
+        for message in batch:
+          message["attempts"] = message["attempts"] + 1
+        # Give up on messages that have failed too many times
+        dropped = set(id(i) for i in batch if i["attempts"] > self.retries)
+        if len(dropped) > 0:
+          logging.warning("notifier - dropping " + str(len(dropped)) + " messages to " + sink + " after " + str(self.retries) + " retries")
+          self.outbox = [i for i in self.outbox if id(i) not in dropped]
+        # Exponential backoff with a little jitter, capped at 10 minutes
+        wait = min(600, 2 ** max(i["attempts"] for i in batch)) + random.random()
+
+      metrics.messageSendSeconds.observe(time.perf_counter() - started, system=self.system, sink=sink)
+      self.saveOutbox()
+      if wait > 0:
+        await asyncio.sleep(wait)
@@ -0,0 +1,159 @@
+import logging
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from . import metrics
+from .models import loads, switchFromJson
+
+### PluralKit API client ###
+# Shared by serve-whome.py and switchout.py, keeps connections open between calls and paces requests using the
+# rate limit headers PluralKit sends back rather than sleeping a fixed amount between every call
+
+# The path without the system id, so every system's calls to an endpoint are counted together
+def endpointName(path):
+  parts = path.split("?")[0].strip("/").split("/")
+  if len(parts) > 1:
+    parts[1] = ":id"
+  return "/" + "/".join(parts)
+
+# Token bucket, starts with PluralKit's documented limit and is corrected by each response's X-RateLimit-* headers
+# One of these is shared by every client in the process so the limit covers all systems together
+class rateLimiter:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.limit = 10
+    self.remaining = 10
+    self.resetAt = 0.0
+
+  # Wait until the bucket has a token to spend on a request
+  def acquire(self):
+    started = time.perf_counter()
+    while True:
+      with self.lock:
+        now = time.time()
+        if now >= self.resetAt:
+          self.remaining = self.limit
+          self.resetAt = now + 1
+        if self.remaining > 0:
+          self.remaining = self.remaining - 1
+          break
+        wait = self.resetAt - now
+      time.sleep(wait)
+    metrics.pkRateLimitWaitSeconds.inc(time.perf_counter() - started)
+
+  # Update the bucket from the rate limit headers on a response
+  def update(self, r):
+    try:
+      with self.lock:
+        if "X-RateLimit-Limit" in r.headers:
+          self.limit = int(r.headers["X-RateLimit-Limit"])
+        if "X-RateLimit-Remaining" in r.headers:
+          self.remaining = int(r.headers["X-RateLimit-Remaining"])
+        if "X-RateLimit-Reset" in r.headers:
+          # PluralKit sends this in milliseconds since the epoch
+          reset = float(r.headers["X-RateLimit-Reset"])
+          self.resetAt = reset / 1000 if reset > 1e11 else reset
+    except ValueError as e:
+      logging.warning("pkClient - unreadable rate limit headers")
+      logging.warning(e)
+
+class pkClient:
+  def __init__(self, token, baseUrl="https://api.pluralkit.me/v2", timeout=10, retries=5, session=None, limiter=None):
+    self.token = token
+    self.baseUrl = baseUrl.rstrip("/")
+    self.timeout = timeout
+    self.retries = retries
+
+    # Keep-alive connection pool, sized for the handful of jobs that can talk to PluralKit at once
+    if session is None:
+      session = requests.Session()
+      session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+      session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+      session.headers.update({"User-Agent": "serve-whome"})
+    self.session = session
+    self.limiter = limiter if limiter is not None else rateLimiter()
+
+  # A client for another system's token that shares this one's connections and rate limit
+  def forToken(self, token):
+    return pkClient(token, self.baseUrl, self.timeout, self.retries, self.session, self.limiter)
+
+  # How long to wait after a 429 before trying again
+  def retryAfter(self, r, attempt):
+    try:
+      # retry_after in the body is in milliseconds
+      return r.json()["retry_after"] / 1000
+    except Exception:
+      return max(self.limiter.resetAt - time.time(), self.backoff(attempt))
+
+  # Exponential backoff with a little jitter, capped at 30 seconds
+  def backoff(self, attempt):
+    return min(30, 2 ** attempt) + random.random()
+
+  # Make a request, retrying on rate limits, server errors and dropped connections
+  # Raises a requests.exceptions.RequestException if it still fails after all retries
+  def request(self, method, path, **kwargs):
+    endpoint = endpointName(path)
+    for attempt in range(self.retries + 1):
+      self.limiter.acquire()
+      started = time.perf_counter()
+      try:
+        r = self.session.request(method, self.baseUrl + path, headers={"Authorization": self.token}, timeout=self.timeout, **kwargs)
+      except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+        metrics.pkRequests.inc(method=method, endpoint=endpoint, status="error")
+        if attempt == self.retries:
+          raise
+        metrics.pkRetries.inc(reason="connection")
+        logging.warning("pkClient - " + method + " " + path + " failed, retrying")
+        logging.warning(e)
+        time.sleep(self.backoff(attempt))
+        continue
+
+      self.limiter.update(r)
+      metrics.pkRequestSeconds.observe(time.perf_counter() - started, method=method, endpoint=endpoint)
+      metrics.pkRequests.inc(method=method, endpoint=endpoint, status=r.status_code)
+
+      if attempt < self.retries and r.status_code == 429:
+        logging.info("pkClient - rate limited on " + path)
+        metrics.pkRetries.inc(reason="ratelimit")
+        time.sleep(self.retryAfter(r, attempt))
+        continue
+      if attempt < self.retries and r.status_code >= 500:
+        logging.warning("pkClient - " + method + " " + path + " returned " + str(r.status_code) + ", retrying")
+        metrics.pkRetries.inc(reason="server")
+        time.sleep(self.backoff(attempt))
+        continue
+
+      r.raise_for_status()
+      return r
+
+  def get(self, path, params=None):
+    return loads(self.request("GET", path, params=params).content)
+
+### Typed calls ###
+# The system, members and groups are returned as PluralKit sent them so they can be saved as they are, switches are
+# returned with their member ids normalised, see models.py
+
+  def getSystem(self, systemId):
+    return self.get("/systems/" + systemId)
+
+  def getMembers(self, systemId):
+    return self.get("/systems/" + systemId + "/members")
+
+  def getGroups(self, systemId, withMembers=True):
+    return self.get("/systems/" + systemId + "/groups", {"with_members": "true" if withMembers else "false"})
+
+  # Switches come back newest first, before is a timestamp to page back through history
+  def getSwitches(self, systemId, before=None, limit=100):
+    params = {"limit": limit}
+    if before is not None:
+      params["before"] = before
+    return [switchFromJson(i) for i in self.get("/systems/" + systemId + "/switches", params)]
+
+  def getSwitch(self, systemId, switchId):
+    return switchFromJson(self.get("/systems/" + systemId + "/switches/" + switchId))
+
+  # Log a switch, an empty member list switches everyone out
+  def postSwitch(self, systemId, members):
+    return switchFromJson(loads(self.request("POST", "/systems/" + systemId + "/switches", json={"members": members}).content))
@@ -0,0 +1,966 @@
+import logging
+import os
+import datetime
+import hashlib
+import time
+from pktools import pktools
+from .switchstore import switchStore, toEpoch
+from .stats import frontStats
+from .history import frontHistory
+from .journal import changeJournal, journalNames
+from .models import loads, dumps, systemModel, memberModel, groupModel, switchFromJson
+from .avatars import avatarCache
+from .compress import gzipBytes, brotliBytes
+from . import metrics
+
+# Precomputed data for the pages in html/, one file per page so each refresh is a single small request
+viewNames = ["viewWhome", "viewSystem"]
+
+# PluralKit's own data, saved as it came but only held in memory as models, see models.py
+rawNames = ["pkSystem", "pkMembers", "pkGroups"]
+
+### Data store loading functions ###
+# Loads in data stores and holds them in memory, all calls to pluralkit go through the client passed in
+class pktState:
+  def __init__(self, config, pk):
+    self.config = config
+    self.pk = pk
+    self.systemid = config["pluralkit"]["systemID"]
+    self.zeropoint = config["pluralkit"]["zeropoint"]
+    self.pkSystem = None
+    self.pkMembers = None
+    self.pkGroups = None
+    self.lastSwitch = None
+    self.currentFronters = None
+    self.stats = None
+    self.memberList = None
+    self.memberSeen = {}
+    # memberSeen with the timestamps already parsed, pkid: [ lastIn epoch, lastOut epoch ], kept in step with memberSeen
+    self.seenEpochs = {}
+    self.zeropointEpoch = toEpoch(self.zeropoint)
+    # Last seen and headspace values for messages, worked out once per member for each switch, see lastSeenValues()
+    self.lastSeenCache = {}
+    self.lastSeenSwitch = None
+    self.membersById = {}
+    self.membersByUuid = {}
+    self.groupsById = {}
+    self.cardLookup = {}
+    self.elementLookup = {}
+    self.coverIds = set()
+    self.hashes = {}
+    self.pending = {}
+    self.texts = {}
+    self.memberListDate = None
+    self.dataLocation = os.path.expanduser(self.config["data"])
+    self.switchStore = switchStore(self.dataLocation + "/pkSwitches.db")
+    # True while memberSeen has been built from a switch history that hasn't been fully downloaded yet, see setMemberSeenPartial()
+    self.memberSeenPartial = self.switchStore.isMemberSeenPartial()
+    # Who was fronting when, built from the switch history by rebuildHistory() and kept up to date as switches come in
+    self.history = None
+    if not os.path.exists(self.dataLocation + "/history"):
+      os.mkdir(self.dataLocation + "/history")
+    # Versioned record of what changed in each save, only kept if turned on in the config
+    self.journal = None
+    journal = config.get("journal") or {}
+    if journal.get("enabled"):
+      self.journal = changeJournal(self.dataLocation, journal.get("segmentBytes", 1024 * 1024), journal.get("keepSegments", 8), bool(config.get("fsync")))
+    # Local copies of members' avatars, only kept if turned on in the config
+    self.avatars = None
+    if (config.get("avatars") or {}).get("enabled"):
+      self.avatars = avatarCache(self.dataLocation, config["avatars"].get("size", 128))
+
+
+### local file loading and saving ###
+# Every data file remembers a hash of what was last loaded or saved, so saving unchanged data doesn't touch the disc
+# Saving only stages the new contents, flush() then writes everything staged in one go at the end of an update, each file
+# going to a temporary file first and being renamed into place so the web server never hands out a half written file
+# Save functions return True if the file has changed and will be written
+
+  # Read a json data file and remember its hash
+  def loadData(self, name):
+    with open(self.dataLocation + "/" + name + ".json", "r") as lsFile:
+      text = lsFile.read()
+    data = loads(text)
+    self.hashes[name] = hashlib.sha256(dumps(data).encode()).hexdigest()
+    if name not in rawNames:
+      self.texts[name] = text
+    return data
+
+  # Stage a json data file to be written by the next flush, unless it is identical to the copy already on disc
+  def saveData(self, name, data):
+    started = time.perf_counter()
+    text = dumps(data)
+    digest = hashlib.sha256(text.encode()).hexdigest()
+    metrics.saveSeconds.observe(time.perf_counter() - started, system=self.systemid, name=name.split("/")[0])
+    if self.hashes.get(name) == digest:
+      return False
+    if self.journal is not None and name in journalNames:
+      previous = self.previousText(name)
+      self.journal.record(name, loads(previous) if previous is not None else None, loads(text))
+    self.pending[name] = text
+    self.hashes[name] = digest
+    if name not in rawNames:
+      self.texts[name] = text
+    return True
+
+  # Write out every staged data file
+  # The client views are made here, only when the data they are made from is about to be written, and they get .gz and .br
+  # copies alongside them so nginx can hand them out already compressed ( gzip_static / brotli_static )
+  def flush(self):
+    if self.currentFronters is not None and ("currentFronters" in self.pending or not self.hasData("viewWhome")):
+      self.saveData("viewWhome", self.buildWhomeView())
+    if self.memberList is not None and ("memberList" in self.pending or not self.hasData("viewSystem")):
+      self.saveData("viewSystem", self.buildSystemView())
+
+    for name in list(self.pending.keys()):
+      path = self.dataLocation + "/" + name + ".json"
+      started = time.perf_counter()
+      try:
+        data = self.pending[name].encode()
+        if name in viewNames:
+          self.writeFile(path + ".gz", gzipBytes(data))
+          compressed = brotliBytes(data)
+          if compressed is not None:
+            self.writeFile(path + ".br", compressed)
+        self.writeFile(path, data)
+        del self.pending[name]
+        # Every history file is counted under history, rather than one label per month
+        metrics.writeSeconds.observe(time.perf_counter() - started, system=self.systemid, name=name.split("/")[0])
+        metrics.filesWritten.inc(system=self.systemid, name=name.split("/")[0])
+      except Exception as e:
+        metrics.writeErrors.inc(system=self.systemid, name=name.split("/")[0])
+        # Leave it staged so the next flush tries again
+        logging.warning("pktState - unable to write " + path)
+        logging.warning(e)
+
+    # Changes are only added to the journal once the files they describe have been written
+    if self.journal is not None:
+      try:
+        self.journal.write(self.journalDocuments)
+      except Exception as e:
+        logging.warning("pktState - unable to write the change journal")
+        logging.warning(e)
+
+  # The latest contents of a data file, from memory or, for PluralKit's data and data sets that aren't loaded at startup, from disc
+  def previousText(self, name):
+    if name in self.pending:
+      return self.pending[name]
+    if name in self.texts:
+      return self.texts[name]
+    if self.hasData(name):
+      try:
+        with open(self.dataLocation + "/" + name + ".json", "r") as dataFile:
+          return dataFile.read()
+      except Exception as e:
+        logging.warning("pktState - unable to read " + name)
+        logging.warning(e)
+    return None
+
+  # Every journaled data set as it is now, for the change journal's snapshots
+  def journalDocuments(self):
+    documents = {}
+    for name in journalNames:
+      text = self.previousText(name)
+      if text is not None:
+        documents[name] = loads(text)
+    return documents
+
+  # Write a file through a temporary file, so nothing ever reads it half written
+  def writeFile(self, path, data):
+    temporary = os.path.dirname(path) + "/." + os.path.basename(path) + ".tmp"
+    with open(temporary, "wb") as outputFile:
+      outputFile.write(data)
+      if self.config.get("fsync"):
+        outputFile.flush()
+        os.fsync(outputFile.fileno())
+    os.replace(temporary, path)
+
+  def loadPkSystem(self):
+    try:
+      self.pkSystem = systemModel(self.loadData("pkSystem"))
+    except Exception as e:
+      logging.critical("pktState - loadPkSystem")
+      logging.critical(e)
+      exit()
+
+  # Keep the system as a model and stage what PluralKit sent to be saved as it is
+  # Returns: True if it has changed
+  def setPkSystem(self, data):
+    self.pkSystem = systemModel(data)
+    return self.saveData("pkSystem", data)
+
+  def loadPkMembers(self):
+    try:
+      self.pkMembers = [memberModel(i) for i in self.loadData("pkMembers")]
+      self.buildIndexes()
+    except Exception as e:
+      logging.critical("pktState - loadPkMembers")
+      logging.critical(e)
+      exit()
+
+  def setPkMembers(self, data):
+    self.pkMembers = [memberModel(i) for i in data]
+    self.buildIndexes()
+    return self.saveData("pkMembers", data)
+
+  def loadPkGroups(self):
+    try:
+      self.pkGroups = [groupModel(i) for i in self.loadData("pkGroups")]
+      self.buildIndexes()
+    except Exception as e:
+      logging.critical("pktState - loadPkGroup")
+      logging.critical(e)
+      exit()
+
+  def setPkGroups(self, data):
+    self.pkGroups = [groupModel(i) for i in data]
+    self.buildIndexes()
+    return self.saveData("pkGroups", data)
+
+  def loadLastSwitch(self):
+    try:
+      self.lastSwitch = self.loadData("lastSwitch")
+      if "id" in self.lastSwitch:
+        self.lastSwitch = switchFromJson(self.lastSwitch)
+    except Exception as e:
+      logging.critical("pktState - loadLastSwitch")
+      logging.critical(e)
+      exit()
+
+  def saveLastSwitch(self):
+    return self.saveData("lastSwitch", self.lastSwitch)
+
+  def loadMemberSeen(self):
+    try:
+      self.memberSeen = self.loadData("memberSeen")
+      self.seenEpochs = {pkid: [toEpoch(seen["lastIn"]), toEpoch(seen["lastOut"])] for pkid, seen in self.memberSeen.items()}
+    except Exception as e:
+      logging.critical("pktState - loadMemberSeen")
+      logging.critical(e)
+      exit()
+
+  def saveMemberSeen(self):
+    return self.saveData("memberSeen", self.memberSeen)
+
+  def loadMemberList(self):
+    try:
+      self.memberList = self.loadData("memberList")
+    except Exception as e:
+      logging.critical("pktState - loadMemberList")
+      logging.critical(e)
+      exit()
+
+  def saveMemberList(self):
+    return self.saveData("memberList", self.memberList)
+
+  # stats are rebuilt from the switch history at startup, so like currentFronters are only ever saved
+  def saveStats(self):
+    return self.saveData("stats", self.stats)
+
+  # currentFronters is live data, so is never loaded from disc, but will be saved to be accessible via web requests
+  def saveCurrentFronters(self):
+    return self.saveData("currentFronters", self.currentFronters)
+
+
+### api calls ###
+
+# The system, members and groups are staged to be saved as soon as they are fetched
+# Returns: True if they have changed since they were last saved
+
+  # Get the system data from the PluralKit API
+  def makeApiCallPkSystem(self):
+    logging.info("( makeApiCallPkSystem )")
+    try:
+      return self.setPkSystem(self.pk.getSystem(self.systemid))
+    except Exception as e:
+      logging.warning("PluralKit api call ( makeApiCallPkSystem )")
+      logging.warning(e)
+      return False
+
+  # Get the data about system members from the PluralKit API
+  def makeApiCallPkMembers(self):
+    logging.info("( makeApiCallPkMembers )")
+    try:
+      return self.setPkMembers(self.pk.getMembers(self.systemid))
+    except Exception as e:
+      logging.warning("PluralKit api call ( makeApiCallPkMembers )")
+      logging.warning(e)
+      return False
+
+  # Get the data about system groups from the PluralKit API
+  def makeApiCallPkGroups(self):
+    logging.info("( makeApiCallPkGroups )")
+    try:
+      return self.setPkGroups(self.pk.getGroups(self.systemid))
+    except Exception as e:
+      logging.warning("PluralKit api call ( makeApiCallPkGroups )")
+      logging.warning(e)
+      return False
+
+  # Get the raw data about the most recent switch from the PluralKit API
+  def makeApiCallLastSwitch(self):
+    logging.info("( makeApiCallLastSwitch )")
+    try:
+      switches = self.pk.getSwitches(self.systemid, limit=1)
+      self.lastSwitch = switches[0]
+    except Exception as e:
+      logging.warning("PluralKit api call ( makeApiCallPkSwitch )")
+      logging.warning(e)
+
+
+### Utility funcations ###
+
+  # Whether a data file has been saved before, so can be loaded rather than fetched
+  def hasData(self, name):
+    return os.path.exists(self.dataLocation + "/" + name + ".json")
+
+  # Whether everything needed to work out the current fronters has been loaded or fetched
+  def isReady(self):
+    return self.pkSystem is not None and self.pkMembers is not None and self.pkGroups is not None and self.lastSwitch is not None
+
+  # Rebuild the lookup tables for members and groups, needs calling whenever pkMembers or pkGroups are reloaded
+  def buildIndexes(self):
+    self.membersById = {}
+    self.membersByUuid = {}
+    for member in self.pkMembers or []:
+      self.membersById[member.id] = member
+      self.membersByUuid[member.uuid] = member
+
+    self.groupsById = {}
+    for group in self.pkGroups or []:
+      self.groupsById[group.id] = group
+
+    # Cards and elements can only be worked out once groups are loaded
+    if self.pkGroups is not None:
+      self.cardLookup = self.getGroupMemberships("cards")
+      self.elementLookup = self.getGroupMemberships("elements")
+
+    self.coverIds = set((self.config["covers"] or {}).values())
+
+  # Where a member's avatar can be fetched from, ( thumbnail, full size ), the local copies if they have been downloaded
+  # Local paths are relative to the data directory, so they work for both nginx and the built in web server
+  def avatarUrl(self, member):
+    if self.avatars is not None and member.avatarUrl:
+      local = self.avatars.lookup(member.avatarUrl)
+      if local is not None:
+        return local
+    return (member.avatarUrl, member.avatarUrl)
+
+  # Download any members' avatars that are new or have changed
+  # This is slow on a first run or with a slow CDN, so it is run by its own job without the state lock, see whomeDaemon.avatarJob()
+  # Returns: True if any avatar changed
+  def syncAvatars(self):
+    if self.avatars is None or self.pkMembers is None:
+      return False
+    logging.info("( syncAvatars )")
+    return self.avatars.sync([member.avatarUrl for member in self.pkMembers])
+
+  # Point currentFronters and memberList at the avatars syncAvatars() has just downloaded, run with the state lock held
+  # Returns: False, there is no switch
+  def applyAvatars(self):
+    if self.currentFronters is not None:
+      self.updateCurrentFronters()
+      self.saveCurrentFronters()
+    if self.memberList is not None:
+      self.buildMemberList()
+      self.saveMemberList()
+    return False
+
+  def getGroupById(self, id):
+    return self.groupsById.get(id)
+
+  # Return a dictionary of which group members are in
+  def getGroupMemberships(self, groupType):
+    output = {}
+    for groupId in self.config["groups"][groupType]:
+      group = self.getGroupById(groupId)
+      for memberId in group.members:
+        output[memberId] = group
+    return output
+
+### Member Last Seen Logic ###
+
+  def checkMemberSeen(self):
+    # Ensure the MemberSeen object has an entry for all system members
+    for member in self.pkMembers:
+      if member.id not in self.memberSeen.keys():
+        self.memberSeen[member.id] = {"lastIn": self.zeropoint, "lastOut": self.zeropoint}
+        self.seenEpochs[member.id] = [self.zeropointEpoch, self.zeropointEpoch]
+
+
+  # Update memberSeen for the members that switched in or out between two consecutive switches, nobody else is touched
+  # Switches from the local store carry their epoch already, anything else has its timestamp parsed once here
+  def applySwitch(self, previousSwitch, thisSwitch):
+    previousMembers = set(previousSwitch["members"])
+    thisMembers = set(thisSwitch["members"])
+    if previousMembers == thisMembers:
+      return
+    epoch = thisSwitch["epoch"] if "epoch" in thisSwitch else toEpoch(thisSwitch["timestamp"])
+
+    # A system member has left as of this switch
+    for pkid in previousMembers - thisMembers:
+      epochs = self.seenFor(pkid)
+      if epochs[1] < epoch:
+        epochs[1] = epoch
+        self.memberSeen[pkid]["lastOut"] = thisSwitch["timestamp"]
+
+    # A system member has joined as of this switch
+    for pkid in thisMembers - previousMembers:
+      epochs = self.seenFor(pkid)
+      if epochs[0] < epoch:
+        epochs[0] = epoch
+        self.memberSeen[pkid]["lastIn"] = thisSwitch["timestamp"]
+
+  # The parsed lastIn and lastOut for a member, adding them to memberSeen if they haven't been seen before
+  def seenFor(self, pkid):
+    epochs = self.seenEpochs.get(pkid)
+    if epochs is None:
+      self.memberSeen.setdefault(pkid, {"lastIn": self.zeropoint, "lastOut": self.zeropoint})
+      epochs = self.seenEpochs[pkid] = [toEpoch(self.memberSeen[pkid]["lastIn"]), toEpoch(self.memberSeen[pkid]["lastOut"])]
+    return epochs
+
+  # How long ago a member last fronted, in real time and headspace time, for switch messages
+  # These only change when there is a switch, so they are worked out once per member for each switch and then looked up
+  def lastSeenValues(self, memberId):
+    cache = self.switchCache()
+    epochs = self.seenFor(memberId)
+    key = (memberId, epochs[1])
+    values = cache.get(key)
+    if values is None:
+      values = {
+        "realTime": str(pktools.rsLastSeen(memberId, self.memberSeen))[:-10],
+        "lastOut": datetime.datetime.fromtimestamp(epochs[1], datetime.timezone.utc).strftime("%A the %d of %B at %H:%M"),
+        "headspaceTime": str(pktools.hsTimeHuman(pktools.hsLastSeen(memberId, self.memberSeen)))
+      }
+      cache[key] = values
+    return values
+
+  # Current headspace time, worked out once for each switch
+  def headspaceNow(self):
+    cache = self.switchCache()
+    if "now" not in cache:
+      cache["now"] = str(pktools.hsTimeEasy(pktools.hsTimeNow(self.zeropoint)))
+    return cache["now"]
+
+  # The cache behind lastSeenValues() and headspaceNow(), emptied whenever there is a new switch
+  def switchCache(self):
+    switchId = self.lastSwitch.get("id") if self.lastSwitch is not None else None
+    if switchId != self.lastSeenSwitch:
+      self.lastSeenCache = {}
+      self.lastSeenSwitch = switchId
+    return self.lastSeenCache
+
+  # Given switches in chronological order, updates the MemberSeen data
+  # The first switch is the one that was already processed last time, it is only used to see who switched in or out of the next one
+  def updateMemberSeen(self, switches):
+    for previousSwitch, thisSwitch in zip(switches, switches[1:]):
+      self.applySwitch(previousSwitch, thisSwitch)
+
+  # Remember whether memberSeen was built from an incomplete history, in the switch store so it lasts over a restart
+  def setMemberSeenPartial(self, partial):
+    self.memberSeenPartial = partial
+    self.switchStore.setMemberSeenPartial(partial)
+
+  # Replays the whole local switch history to build memberSeen from scratch, no network calls are made here
+  def rebuildMemberSeen(self):
+    logging.info("( rebuildMemberSeen )")
+    self.memberSeen = {}
+    self.seenEpochs = {}
+    self.checkMemberSeen()
+
+    previousSwitch = None
+    for thisSwitch in self.switchStore.all():
+      # The very first switch has nothing to compare against
+      if previousSwitch is not None:
+        self.applySwitch(previousSwitch, thisSwitch)
+      previousSwitch = thisSwitch
+
+  # Brings the local switch history up to date with pluralkit, only switches newer than the newest stored one are requested
+  # New switches are only saved once the whole gap is fetched, so an interrupted sync never leaves a hole in the history
+  def syncNewSwitches(self):
+    logging.info("( syncNewSwitches )")
+    newSwitches = []
+    pointer = None
+    while self.switchStore.newest() is not None:
+      switches = self.pk.getSwitches(self.systemid, before=pointer)
+      newSwitches = newSwitches + [i for i in switches if not self.switchStore.contains(i["id"])]
+      if len(switches) < 100 or any(self.switchStore.contains(i["id"]) for i in switches):
+        break
+      pointer = switches[-1]["timestamp"]
+    self.switchStore.add(newSwitches)
+
+  # Fetch one page of the history that hasn't been downloaded yet, going backwards from the oldest stored switch
+  # The page is stored as soon as it arrives and the oldest stored switch is the cursor, so the store is its own checkpoint and
+  # an interrupted backfill carries on from the last page it stored
+  # Returns: True once the very first switch has been reached
+  def backfillPage(self):
+    oldest = self.switchStore.oldest()
+    pointer = oldest["timestamp"] if oldest is not None else None
+    logging.info("Getting switches before " + str(pointer))
+    switches = self.pk.getSwitches(self.systemid, before=pointer)
+    self.switchStore.add(switches)
+    # Stop if we've reached the very last switch
+    if len(switches) < 100:
+      self.switchStore.setComplete(True)
+      return True
+    return False
+
+  # How far the backfill has got, percent is how much of the time since the system was created is covered
+  def backfillProgress(self):
+    oldest = self.switchStore.oldest()
+    progress = {"complete": self.switchStore.isComplete(), "switches": self.switchStore.count(), "oldest": oldest["timestamp"] if oldest is not None else None, "percent": None}
+    if progress["complete"]:
+      progress["percent"] = 100.0
+    elif oldest is not None and self.pkSystem is not None and self.pkSystem.created:
+      created = toEpoch(self.pkSystem.created)
+      now = datetime.datetime.now(datetime.timezone.utc).timestamp()
+      if now > created:
+        progress["percent"] = round(max(0.0, min(100.0, (now - toEpoch(oldest["timestamp"])) / (now - created) * 100)), 1)
+    return progress
+
+  # Rebuild everything worked out from the switch history, called as the background backfill goes along and once it finishes
+  # While the history is incomplete memberSeen is only rebuilt if it was built from partial history in the first place, a
+  # memberSeen loaded from disc is already complete so it is left alone until the whole history is here
+  def backfillCheckpoint(self):
+    logging.info("( backfillCheckpoint )")
+    complete = self.switchStore.isComplete()
+    if complete:
+      # Pick up anything that arrived while the backfill was running but couldn't be added to the store
+      try:
+        self.syncNewSwitches()
+      except Exception as e:
+        logging.warning("Unable to sync new switches ( backfillCheckpoint )")
+        logging.warning(e)
+    if complete or self.memberSeenPartial:
+      self.rebuildMemberSeen()
+      self.setMemberSeenPartial(not complete)
+      self.saveMemberSeen()
+      self.updateCurrentFronters()
+      self.saveCurrentFronters()
+      self.buildMemberList()
+      self.saveMemberList()
+    self.buildStats()
+    self.saveStats()
+    self.rebuildHistory()
+
+
+### data sets for other WhoMe projects ###
+
+  # lastSwitch is empty when the system has no switches at all, then nobody is fronting
+  def updateCurrentFronters(self):
+    self.currentFronters = {
+      "switch": {
+        "id": self.lastSwitch.get("id"),
+        "timestamp": self.lastSwitch.get("timestamp")
+      },
+      "system": {
+        "name": self.pkSystem.name,
+        "pronouns": self.pkSystem.pronouns
+      },
+      "members": []
+    }
+
+    # Get details for each fronter, anyone not in the member list yet is left out until the members are fetched again
+    for memberId in self.lastSwitch.get("members", []):
+      member = self.membersById.get(memberId)
+      if member is None:
+        logging.warning("pktState - unknown fronter " + str(memberId))
+        continue
+      card = self.cardLookup.get(member.uuid)
+      element = self.elementLookup.get(member.uuid)
+      self.currentFronters["members"].append({
+        "name": member.name,
+        "displayName": member.displayName,
+        "id": member.id,
+        "pronouns": member.pronouns,
+        "cardSuit": card.name if card is not None else "",
+        "cardId": card.id if card is not None else "",
+        "elementName": element.name if element is not None else "",
+        "elementId": element.id if element is not None else "",
+        "lastIn": self.memberSeen.get(memberId, {"lastIn": self.zeropoint})["lastIn"],
+        "lastOut": self.memberSeen.get(memberId, {"lastOut": self.zeropoint})["lastOut"],
+        "avatarUrl": self.avatarUrl(member)[0],
+        "visible": member.visible
+      })
+
+  # Work out front time statistics from the local switch history, see stats.py
+  def buildStats(self):
+    logging.info("( buildStats )")
+    self.stats = frontStats(self.switchStore.history(), (self.config.get("stats") or {}).get("recentDays", 28)).toJson()
+
+  # Build the front history from the local switch history and save every month of it, see history.py
+  def rebuildHistory(self):
+    logging.info("( rebuildHistory )")
+    self.history = frontHistory(self.switchStore.history())
+    self.saveHistory()
+
+  # Add new switches, oldest first, to the end of the front history and save the months they change
+  def extendHistory(self, switches):
+    if self.history is None:
+      return
+    since = self.history.epochs[-1] if len(self.history) > 0 else None
+    try:
+      self.history.extend((toEpoch(switch["timestamp"]), switch["members"]) for switch in switches)
+    except ValueError:
+      self.rebuildHistory()
+      return
+    self.saveHistory(since)
+
+  # Stage history/YYYY-MM.json for every month from since on, or all of them, and history/index.json listing the months
+  # Files already on disc are loaded first so unchanged months aren't written again after a restart, and when every month
+  # is saved files for months no longer in the history are removed
+  def saveHistory(self, since=None):
+    months = self.history.months(since)
+    files = [("history/" + month, self.history.monthJson(month)) for month in months] + [("history/index", self.history.indexJson())]
+    for name, data in files:
+      if name not in self.hashes and self.hasData(name):
+        try:
+          self.loadData(name)
+        except Exception as e:
+          logging.warning("pktState - unable to read " + name)
+          logging.warning(e)
+      self.saveData(name, data)
+
+    if since is None:
+      for fileName in os.listdir(self.dataLocation + "/history"):
+        name = "history/" + fileName[:-5]
+        if fileName.endswith(".json") and fileName[:-5] not in months and fileName != "index.json":
+          try:
+            os.remove(self.dataLocation + "/" + name + ".json")
+          except OSError as e:
+            logging.warning("pktState - unable to remove " + name)
+            logging.warning(e)
+          self.hashes.pop(name, None)
+          self.texts.pop(name, None)
+          self.pending.pop(name, None)
+
+  def buildMemberList(self):
+
+    self.memberList = []
+    self.memberListDate = datetime.date.today()
+    now = datetime.datetime.now(datetime.timezone.utc).timestamp()
+
+    # Create the list of members to output
+    for member in self.pkMembers:
+
+      # check if this is a member that should not appear in the list
+      if member.id in self.coverIds:
+        # skip this member as they are just a 'cover' member
+        continue
+
+      card = self.cardLookup.get(member.uuid)
+      element = self.elementLookup.get(member.uuid)
+      avatar = self.avatarUrl(member)
+
+      self.memberList.append({
+        "name": member.name,
+        "id": member.id,
+        "pronouns": member.pronouns,
+        "displayName": member.displayName,
+        "avatarUrl": avatar[0],
+        "avatarFullUrl": avatar[1],
+        "cardSuit": card.name if card is not None else "",
+        "cardId": card.id if card is not None else "",
+        "elementName": element.name if element is not None else "",
+        "elementId": element.id if element is not None else "",
+        "visible": member.visible,
+        # Whole days since they last fronted, the same as pktools.rsLastSeen().days without parsing the timestamp again
+        "lastSeen": int((now - self.seenFor(member.id)[1]) // 86400),
+        "tag": member.tag
+      })
+
+
+### Client views ###
+# Everything a page needs, already joined and sorted, so the browser doesn't have to fetch and scan several data sets
+
+  # whome.html: the current fronters with their member details, and their memberSeen entries for pktools.js
+  def buildWhomeView(self):
+    fronters = []
+    memberSeen = {}
+    for member in self.currentFronters["members"]:
+      fronter = dict(member)
+      fronter["lastInEpoch"] = self.seenFor(member["id"])[0]
+      fronters.append(fronter)
+      memberSeen[member["id"]] = {"lastIn": member["lastIn"], "lastOut": member["lastOut"]}
+    return {"switch": self.currentFronters["switch"], "system": self.currentFronters["system"], "fronters": fronters, "memberSeen": memberSeen}
+
+  # system.html: the member directory, sorted by name
+  def buildSystemView(self):
+    fields = ["id", "name", "displayName", "pronouns", "cardSuit", "elementName", "avatarUrl", "visible", "lastSeen"]
+    members = [{field: member[field] for field in fields} for member in self.memberList]
+    members.sort(key=lambda member: member["name"].lower())
+    return {"members": members}
+
+
+### Periodic data update functions ###
+
+  # Refresh the system, members and groups from pluralkit, this catches changes that don't show up in switches
+  # Only files whose contents changed are rewritten, and only the outputs that depend on them are rebuilt
+  def refresh(self):
+    logging.info("( refresh )")
+
+    systemChanged = self.makeApiCallPkSystem()
+    membersChanged = self.makeApiCallPkMembers()
+    groupsChanged = self.makeApiCallPkGroups()
+
+    # New members need an entry in memberSeen
+    seenChanged = False
+    if membersChanged:
+      self.checkMemberSeen()
+      seenChanged = self.saveMemberSeen()
+
+    # Names, pronouns, cards and elements of the current fronters may have changed
+    if (systemChanged or membersChanged or groupsChanged) and self.currentFronters is not None:
+      self.updateCurrentFronters()
+      self.saveCurrentFronters()
+
+    # memberList also holds days since last seen, so it needs rebuilding once a day even if nothing else changed
+    if membersChanged or groupsChanged or seenChanged or self.memberListDate != datetime.date.today():
+      self.buildMemberList()
+      self.saveMemberList()
+
+    # The recent window moves on even when there are no switches
+    self.buildStats()
+    self.saveStats()
+
+    # The front going on now carries on into each new month, which gets its own history file
+    if self.history is not None:
+      self.saveHistory(self.history.epochs[-1] if len(self.history) > 0 else None)
+
+    logging.info("Refresh changed: system " + str(systemChanged) + ", members " + str(membersChanged) + ", groups " + str(groupsChanged))
+
+  # Fetch every switch newer than lastSwitch, newest first
+  # A single switch is requested first, so when nothing has happened that is all that is downloaded, otherwise pages of 100
+  # are requested until they reach back to lastSwitch
+  # Returns: ( PluralKit's newest switch or None if there are none, the switches newer than lastSwitch )
+  def fetchNewSwitches(self):
+    switches = self.pk.getSwitches(self.systemid, limit=1)
+    if len(switches) == 0:
+      return None, []
+    newest = switches[0]
+    if newest["id"] == self.lastSwitch.get("id"):
+      return newest, []
+
+    # Without a previous switch to work back to the most recent page is all that is useful
+    if "id" not in self.lastSwitch:
+      return newest, self.pk.getSwitches(self.systemid)
+
+    newSwitches = []
+    pointer = None
+    while True:
+      switches = self.pk.getSwitches(self.systemid, before=pointer)
+      for switch in switches:
+        # Stop at the last switch we processed, or anything older in case it has since been deleted
+        if switch["id"] == self.lastSwitch["id"] or toEpoch(switch["timestamp"]) <= toEpoch(self.lastSwitch["timestamp"]):
+          return newest, newSwitches
+        newSwitches.append(switch)
+      if len(switches) < 100:
+        return newest, newSwitches
+      pointer = switches[-1]["timestamp"]
+
+  # Update information about current fronters and when they most recently switched in and out
+  # Only switches since the last one processed are fetched, and only the members in them are updated
+  # Returns: True if a switch has happened since last update, False otherwise
+  def pullPeriodic(self):
+    switchOccurred = False
+
+    try:
+      # Check to see if any switches have occured
+      logging.info("Getting most recent switches")
+      newest, newSwitches = self.fetchNewSwitches()
+
+      if len(newSwitches) > 0:
+        switchOccurred = self.ingestSwitches(newSwitches)
+      elif (newest or {}).get("id") != self.lastSwitch.get("id"):
+        # Nothing is newer than lastSwitch but PluralKit's newest switch is a different one, so lastSwitch has been deleted
+        self.lastSwitchDeleted(newest)
+
+    except Exception as e:
+      # Fail silently
+      metrics.pullErrors.inc(system=self.systemid)
+      logging.warning("Unable to fetch recent switches ( pullPeriodic )")
+      logging.warning(e)
+
+    return switchOccurred
+
+  # lastSwitch has been deleted in PluralKit, go back to the switch before it, or to no switch at all, and rebuild everything
+  # worked out from the history without it
+  def lastSwitchDeleted(self, newest):
+    logging.info("Last switch " + str(self.lastSwitch.get("id")) + " has been deleted")
+    if "id" in self.lastSwitch:
+      self.switchStore.remove([self.lastSwitch["id"]])
+    self.lastSwitch = newest if newest is not None else {}
+    self.saveLastSwitch()
+    self.rebuildFromHistory()
+
+  # Apply switches newer than lastSwitch, newest first, however they arrived (polling or a dispatch webhook)
+  # Returns: True, so callers can pass it straight on as whether a switch occurred
+  def ingestSwitches(self, newSwitches):
+    previousSwitch = self.lastSwitch
+    logging.info(str(len(newSwitches)) + " new switches")
+    metrics.switchesSeen.inc(len(newSwitches), system=self.systemid)
+    now = datetime.datetime.now(datetime.timezone.utc).timestamp()
+    for switch in newSwitches:
+      metrics.switchLagSeconds.observe(max(now - toEpoch(switch["timestamp"]), 0), system=self.systemid)
+
+    # 1) If there are any members we don't know about yet, refresh the member list, at most once
+    # A dispatched switch can name a member by uuid before the member's own event has arrived, those are given their id now
+    membersChanged = False
+    if any(pkid not in self.membersById for switch in newSwitches for pkid in switch["members"]):
+      logging.info("Unable to find member, rebuilding member data")
+      membersChanged = self.makeApiCallPkMembers()
+      if membersChanged:
+        self.checkMemberSeen()
+      for switch in newSwitches:
+        switch["members"] = self.memberIds(switch["members"])
+
+    # 2) Keep the local switch history current, it can only take the new switches if it already ends at the previous one,
+    # otherwise there would be a gap, so leave it to the next sync
+    newest = self.switchStore.newest()
+    if newest is not None and newest["id"] == previousSwitch.get("id"):
+      self.switchStore.add(newSwitches)
+      self.extendHistory(newSwitches[::-1])
+
+    # 3) Update the information about when fronters were last seen, oldest switch first
+    with metrics.updateMemberSeenSeconds.time(system=self.systemid):
+      self.updateMemberSeen(([previousSwitch] if "id" in previousSwitch else []) + newSwitches[::-1])
+    self.saveMemberSeen()
+
+    # 4) Update the last switch file
+    self.lastSwitch = newSwitches[0]
+    self.saveLastSwitch()
+
+    # 5) New members also need adding to the member list
+    if membersChanged:
+      self.buildMemberList()
+      self.saveMemberList()
+
+    # 6) Front times have changed
+    self.buildStats()
+    self.saveStats()
+    return True
+
+
+### Dispatch webhooks ###
+# PluralKit can post an event to us whenever something changes in the system, see https://pluralkit.me/api/dispatch/
+# New switches and changes to members and the system are applied straight from the event, groups are fetched again as
+# events don't carry group membership, and edits to past switches rebuild memberSeen and stats from the local history
+# Polling carries on less often as a reconciliation pass in case an event is missed
+
+  # Apply one dispatch event, the signing token has already been checked
+  # Returns: True if it was a new switch, so switch messages should be sent
+  def applyDispatch(self, event):
+    eventType = event.get("type")
+    data = event.get("data") or {}
+    logging.info("Dispatch " + str(eventType))
+
+    if eventType == "CREATE_SWITCH":
+      return self.dispatchSwitch(data)
+
+    if eventType in ("UPDATE_SWITCH", "DELETE_SWITCH", "DELETE_ALL_SWITCHES"):
+      self.dispatchSwitchEdit(eventType, event.get("id"))
+      return False
+
+    if eventType in ("CREATE_MEMBER", "UPDATE_MEMBER", "DELETE_MEMBER"):
+      self.dispatchMember(eventType, event.get("id"), data)
+    elif eventType in ("CREATE_GROUP", "UPDATE_GROUP", "UPDATE_GROUP_MEMBERS", "DELETE_GROUP"):
+      if not self.makeApiCallPkGroups():
+        return False
+    elif eventType == "UPDATE_SYSTEM":
+      system = loads(self.previousText("pkSystem"))
+      system.update({key: value for key, value in data.items() if key in system})
+      if not self.setPkSystem(system):
+        return False
+    else:
+      return False
+
+    # Names, pronouns, cards, elements and group memberships feed into these
+    self.updateCurrentFronters()
+    self.saveCurrentFronters()
+    self.buildMemberList()
+    self.saveMemberList()
+    return False
+
+  # A new switch, from a dispatch event or made by this server, ignored if it has already been seen, switches logged in the
+  # past are added to the history instead
+  def dispatchSwitch(self, data):
+    if not all(key in data for key in ("id", "timestamp", "members")):
+      # Not enough in the event to use, poll for it instead
+      return self.pullPeriodic()
+    if data["id"] == self.lastSwitch.get("id") or self.switchStore.contains(data["id"]):
+      return False
+
+    switch = switchFromJson({"id": data["id"], "timestamp": data["timestamp"], "members": self.memberIds(data["members"])})
+
+    if "timestamp" in self.lastSwitch and toEpoch(switch["timestamp"]) < toEpoch(self.lastSwitch["timestamp"]):
+      logging.info("Dispatch switch is older than the last switch, adding it to the history")
+      if any(pkid not in self.membersById for pkid in switch["members"]):
+        if self.makeApiCallPkMembers():
+          self.checkMemberSeen()
+        switch["members"] = self.memberIds(switch["members"])
+      self.switchStore.add([switch])
+      self.rebuildFromHistory()
+      return False
+
+    return self.ingestSwitches([switch])
+
+  # Members may be given by uuid, memberSeen and the rest of the data use their short ids, uuids of members that aren't known
+  # yet are left as they are
+  def memberIds(self, members):
+    return [self.membersByUuid[pkid].id if pkid in self.membersByUuid else pkid for pkid in members]
+
+  # A past switch has been changed or deleted, the local history is corrected and everything worked out from it rebuilt
+  def dispatchSwitchEdit(self, eventType, switchId):
+    if eventType == "DELETE_ALL_SWITCHES":
+      self.switchStore.clear()
+    elif switchId is not None:
+      self.switchStore.remove([switchId])
+      if eventType == "UPDATE_SWITCH":
+        try:
+          self.switchStore.add([self.pk.getSwitch(self.systemid, switchId)])
+        except Exception as e:
+          logging.warning("PluralKit api call ( dispatchSwitchEdit )")
+          logging.warning(e)
+
+    # The edit may have been to the most recent switch
+    self.makeApiCallLastSwitch()
+    if eventType == "DELETE_ALL_SWITCHES" and self.switchStore.count() == 0:
+      self.lastSwitch = {}
+    self.saveLastSwitch()
+    self.rebuildFromHistory()
+
+  # A member has been created, changed or deleted, the event gives the member's uuid
+  # The change is made to the members as PluralKit sent them, which are only kept on disc, and the models made again
+  def dispatchMember(self, eventType, memberRef, data):
+    member = self.membersByUuid.get(memberRef, self.membersById.get(memberRef))
+    members = loads(self.previousText("pkMembers") or "[]")
+    index = next((i for i, raw in enumerate(members) if member is not None and raw.get("uuid") == member.uuid), None)
+    if eventType == "CREATE_MEMBER" and member is None and "id" in data:
+      self.setPkMembers(members + [data])
+    elif eventType == "UPDATE_MEMBER" and index is not None:
+      members[index].update(data)
+      self.setPkMembers(members)
+    elif eventType == "DELETE_MEMBER" and index is not None:
+      self.setPkMembers(members[:index] + members[index + 1:])
+    else:
+      # Not something we can apply from here, fetch the members again
+      self.makeApiCallPkMembers()
+    self.checkMemberSeen()
+    self.saveMemberSeen()
+
+  # Rebuild memberSeen, currentFronters, memberList, stats and the front history from the local switch history
+  # Like backfillCheckpoint(), while the history is still downloading memberSeen is only rebuilt if it was built from partial
+  # history already, a complete memberSeen is kept until the backfill finishes and rebuilds it from the whole history
+  def rebuildFromHistory(self):
+    complete = self.switchStore.isComplete()
+    if complete or self.memberSeenPartial:
+      self.rebuildMemberSeen()
+      self.setMemberSeenPartial(not complete)
+      self.saveMemberSeen()
+    self.updateCurrentFronters()
+    self.saveCurrentFronters()
+    self.buildMemberList()
+    self.saveMemberList()
+    self.buildStats()
+    self.saveStats()
+    self.rebuildHistory()
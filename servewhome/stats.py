@@ -0,0 +1,103 @@
+import array
+import datetime
+import itertools
+
+### Front time statistics ###
+# Works out how long each member has fronted from the local switch history, both over all time and over a recent window
+# The history is turned into arrays of start and end times for each member in one pass, so totals and windows are just
+# sums over those arrays, which is quick enough to rerun after every switch even with tens of thousands of switches
+
+class frontStats:
+  # history is ( epoch, [member ids] ) for every switch in chronological order, as given by switchStore.history()
+  def __init__(self, history, recentDays=28, now=None):
+    self.now = now if now is not None else datetime.datetime.now(datetime.timezone.utc).timestamp()
+    self.recentStart = self.now - recentDays * 86400
+    self.recentDays = recentDays
+
+    # member id: ( array of start times, array of end times )
+    self.intervals = {}
+    # ( member id, member id ): seconds the two were both fronting
+    self.coFront = {}
+    self.firstSwitch = None
+
+    opened = {}
+    previousEpoch = None
+    previousMembers = []
+    for epoch, members in itertools.chain(history, [(self.now, [])]):
+      if self.firstSwitch is None:
+        self.firstSwitch = epoch
+
+      # Time the previous set of fronters spent together
+      if len(previousMembers) > 1:
+        for pair in itertools.combinations(sorted(previousMembers), 2):
+          self.coFront[pair] = self.coFront.get(pair, 0) + epoch - previousEpoch
+
+      # Close the intervals of anyone who has switched out, and open one for anyone who has switched in
+      for pkid in list(opened.keys()):
+        if pkid not in members:
+          starts, ends = self.intervals.setdefault(pkid, (array.array("d"), array.array("d")))
+          starts.append(opened.pop(pkid))
+          ends.append(epoch)
+      for pkid in members:
+        if pkid not in opened:
+          opened[pkid] = epoch
+
+      previousEpoch = epoch
+      previousMembers = members
+
+  # Total time covered by the switch history
+  def allSpan(self):
+    return self.now - self.firstSwitch if self.firstSwitch is not None else 0
+
+  # Length of the recent window, or less if the history doesn't go back that far
+  def recentSpan(self):
+    return self.now - max(self.recentStart, self.firstSwitch) if self.firstSwitch is not None else 0
+
+  # If member is given returns their total fronting time in seconds, otherwise a dictionary of every member's total
+  def allTime(self, member=None):
+    if member is not None:
+      if member not in self.intervals:
+        return 0
+      starts, ends = self.intervals[member]
+      return sum(ends) - sum(starts)
+    return {pkid: self.allTime(pkid) for pkid in self.intervals}
+
+  # Percentage of the whole switch history a member has been fronting for
+  def allPercent(self, member=None):
+    if member is not None:
+      return 100 * self.allTime(member) / self.allSpan() if self.allSpan() > 0 else 0
+    return {pkid: self.allPercent(pkid) for pkid in self.intervals}
+
+  # Time a member has fronted for in the last recentDays days
+  def recentTime(self, member=None):
+    if member is not None:
+      if member not in self.intervals:
+        return 0
+      starts, ends = self.intervals[member]
+      return sum(max(0, end - max(start, self.recentStart)) for start, end in zip(starts, ends) if end > self.recentStart)
+    return {pkid: self.recentTime(pkid) for pkid in self.intervals}
+
+  # Percentage of the last recentDays days a member has been fronting for
+  def recentPercent(self, member=None):
+    if member is not None:
+      return 100 * self.recentTime(member) / self.recentSpan() if self.recentSpan() > 0 else 0
+    return {pkid: self.recentPercent(pkid) for pkid in self.intervals}
+
+  # Everything in a form that can be saved as stats.json, times are in whole seconds
+  def toJson(self):
+    return {
+      "generated": datetime.datetime.fromtimestamp(self.now, datetime.timezone.utc).isoformat(timespec="seconds"),
+      "recentDays": self.recentDays,
+      "members": {
+        pkid: {
+          "allTime": round(self.allTime(pkid)),
+          "allPercent": round(self.allPercent(pkid), 2),
+          "recentTime": round(self.recentTime(pkid)),
+          "recentPercent": round(self.recentPercent(pkid), 2)
+        } for pkid in self.intervals
+      },
+      "coFront": [
+        {"members": list(pair), "time": round(seconds)}
+        for pair, seconds in sorted(self.coFront.items(), key=lambda item: item[1], reverse=True)
+      ]
+    }
@@ -0,0 +1,107 @@
+import sqlite3
+import threading
+import datetime
+from .models import loads, dumps
+
+### Local switch history ###
+# Append-only copy of the system's switch history, kept in sqlite in the data directory so that memberSeen,
+# memberList and stats can be rebuilt from local data without going back to PluralKit
+# The history backfill runs in its own thread alongside polling, so every use of the connection takes the store's lock
+
+# Turn a PluralKit timestamp into seconds since the epoch, used for ordering switches
+def toEpoch(timestamp):
+  return datetime.datetime.fromisoformat(timestamp.replace("Z", "+00:00")).timestamp()
+
+class switchStore:
+  def __init__(self, path):
+    self.db = sqlite3.connect(path, check_same_thread=False)
+    self.lock = threading.RLock()
+    self.db.execute("CREATE TABLE IF NOT EXISTS switches (id TEXT PRIMARY KEY, timestamp TEXT NOT NULL, epoch REAL NOT NULL, members TEXT NOT NULL)")
+    self.db.execute("CREATE INDEX IF NOT EXISTS switchesEpoch ON switches (epoch)")
+    self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    self.db.commit()
+
+  def makeSwitch(self, row):
+    return {"id": row[0], "timestamp": row[1], "members": loads(row[2])}
+
+  # Add a batch of switches in any order, switches already in the store are ignored, member ids are expected to be normalised
+  # already, see models.switchFromJson()
+  # Returns: number of switches that were new
+  def add(self, switches):
+    with self.lock, self.db:
+      before = self.count()
+      self.db.executemany("INSERT OR IGNORE INTO switches (id, timestamp, epoch, members) VALUES (?, ?, ?, ?)", [
+        (switch["id"], switch["timestamp"], toEpoch(switch["timestamp"]), dumps(switch["members"]))
+        for switch in switches
+      ])
+      return self.count() - before
+
+  # Take switches out of the history, when they have been deleted or edited in PluralKit
+  def remove(self, switchIds):
+    with self.lock, self.db:
+      self.db.executemany("DELETE FROM switches WHERE id = ?", [(switchId,) for switchId in switchIds])
+
+  # Empty the history, when every switch has been deleted in PluralKit, there is nothing left to download so it is complete
+  def clear(self):
+    with self.lock, self.db:
+      self.db.execute("DELETE FROM switches")
+      self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('complete', '1')")
+
+  def contains(self, switchId):
+    with self.lock:
+      return self.db.execute("SELECT 1 FROM switches WHERE id = ?", (switchId,)).fetchone() is not None
+
+  def count(self):
+    with self.lock:
+      return self.db.execute("SELECT COUNT(*) FROM switches").fetchone()[0]
+
+  def newest(self):
+    with self.lock:
+      row = self.db.execute("SELECT id, timestamp, members FROM switches ORDER BY epoch DESC, id DESC LIMIT 1").fetchone()
+    return self.makeSwitch(row) if row is not None else None
+
+  def oldest(self):
+    with self.lock:
+      row = self.db.execute("SELECT id, timestamp, members FROM switches ORDER BY epoch ASC, id ASC LIMIT 1").fetchone()
+    return self.makeSwitch(row) if row is not None else None
+
+  # All stored switches in chronological order, read in one go so the lock isn't held while the caller works through them
+  # Each switch also has its epoch, so nothing working through the history needs to parse timestamps
+  def all(self):
+    with self.lock:
+      rows = self.db.execute("SELECT id, timestamp, members, epoch FROM switches ORDER BY epoch ASC, id ASC").fetchall()
+    for row in rows:
+      switch = self.makeSwitch(row)
+      switch["epoch"] = row[3]
+      yield switch
+
+  # ( epoch, [member ids] ) for every stored switch in chronological order, the cheapest form for working out stats
+  def history(self):
+    with self.lock:
+      rows = self.db.execute("SELECT epoch, members FROM switches ORDER BY epoch ASC, id ASC").fetchall()
+    for row in rows:
+      yield (row[0], loads(row[1]))
+
+  # Whether the store holds everything back to the very first switch, set once a full backfill has finished
+  def isComplete(self):
+    return self.getFlag("complete")
+
+  def setComplete(self, complete):
+    self.setFlag("complete", complete)
+
+  # Whether the memberSeen saved in the data directory was built from this store before it was complete, kept here so a
+  # restart part way through the backfill still knows memberSeen needs rebuilding at the next checkpoint
+  def isMemberSeenPartial(self):
+    return self.getFlag("memberSeenPartial")
+
+  def setMemberSeenPartial(self, partial):
+    self.setFlag("memberSeenPartial", partial)
+
+  def getFlag(self, key):
+    with self.lock:
+      row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row is not None and row[0] == "1"
+
+  def setFlag(self, key, value):
+    with self.lock, self.db:
+      self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, "1" if value else "0"))
@@ -1,28 +1,70 @@
 #!/usr/bin/env python3
 
-import requests
-import yaml
+import argparse
 import logging
+import time
+from servewhome.config import loadConfig, systemConfigs
+from servewhome.control import controlPath, sendCommand
+from servewhome.logsetup import setupLogging, logOperation
 
-# Logging setup
-logging.basicConfig(format="%(asctime)s : %(message)s", filename="log-switchout.log", encoding='utf-8', level=logging.INFO)
+# argparse setup
+parser = argparse.ArgumentParser()
+parser.add_argument("-c", "--config", default="./config-serve-whome.yaml", help="Config file to use")
+parser.add_argument("-s", "--system", help="Only switch out this system ID, by default every system in the config is switched out")
+args = parser.parse_args()
 
 # Load config file
-try:
-    with open("./config-serve-whome.yaml", "r") as read_file:
-        config = yaml.safe_load(read_file)
-except:
-    logging.critical("Settings file missing")
+config = loadConfig(args.config)
+if config is None:
     exit()
 
-systemid = config["pluralkit"]["systemID"]
-pktoken = config["pluralkit"]["token"]
-
-logging.info("Attempting to swtich out")
-try:
-    requests.post("https://api.pluralkit.me/v2/systems/" + systemid + "/switches",  headers={'Authorization':pktoken}, json={'members':[]})
-except requests.exceptions.RequestException as e:
-    # Fail silently
-    logging.warning("Unable to swtich out")
-    logging.warning(e) 
-    
\ No newline at end of file
+# Logging setup, this is run by hand or from cron so info is always logged
+setupLogging(config, "switchout", True)
+
+# Ask the running server to do it, it applies the switch and publishes it straight away
+path = controlPath(config)
+if path is not None:
+    try:
+        started = time.perf_counter()
+        reply = sendCommand(path, "switchout", args.system)
+        for systemid, result in reply.get("systems", {}).items():
+            if result["ok"]:
+                logOperation("Switched out " + systemid, "switchout", started, system=systemid, switchId=(result.get("lastSwitch") or {}).get("id"))
+            else:
+                logging.warning("Unable to swtich out " + systemid + ": " + str(result.get("error")))
+        if "error" in reply:
+            logging.warning("Unable to swtich out: " + reply["error"])
+        exit(0 if reply.get("ok") else 1)
+    except (FileNotFoundError, ConnectionRefusedError) as e:
+        # Nothing is listening, so the switch out can't have been started
+        logging.warning("Unable to reach the server's control socket, switching out directly")
+        logging.warning(e)
+    except (OSError, ValueError) as e:
+        # The server had the command but no reply came back, it may still be switching out so don't post another switch
+        logging.warning("No reply from the server's control socket, it may still be switching out")
+        logging.warning(e)
+        exit(1)
+
+# The server isn't running, post the switches to PluralKit ourselves
+import requests
+from servewhome.pkclient import pkClient
+
+pk = None
+for systemConfig in systemConfigs(config):
+    systemid = systemConfig["pluralkit"]["systemID"]
+    if args.system and args.system != systemid:
+        continue
+
+    # Every system shares the one connection pool and rate limit
+    if pk is None:
+        pk = pkClient(None, systemConfig["pluralkit"].get("api", "https://api.pluralkit.me/v2"), systemConfig["pluralkit"].get("timeout", 10), systemConfig["pluralkit"].get("retries", 5))
+
+    logging.info("Attempting to swtich out " + systemid)
+    try:
+        started = time.perf_counter()
+        switch = pk.forToken(systemConfig["pluralkit"]["token"]).postSwitch(systemid, [])
+        logOperation("Switched out " + systemid, "switchout", started, system=systemid, switchId=switch.get("id"))
+    except requests.exceptions.RequestException as e:
+        # Fail silently
+        logging.warning("Unable to swtich out " + systemid)
+        logging.warning(e)